@@ -1,6 +1,10 @@
 from stemhealth import app, db
+from stemhealth.schema import upgrade_schema
 
 if __name__ == '__main__':
+    # Create the tables and bring an existing database up to date before serving (the development server is a
+    # single process; run "flask --app app upgrade-db" before starting the application any other way)
     with app.app_context():
         db.create_all()
-        app.run()
\ No newline at end of file
+        upgrade_schema()
+    app.run()
\ No newline at end of file
@@ -0,0 +1,111 @@
+import argparse
+import datetime as dt
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+# Import the application with an in-memory database, so it does not change site.db
+os.environ.setdefault('STEMHEALTH_DATABASE_URI', 'sqlite:///:memory:')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stemhealth.util import CHART_SPECS, ENV_TIMESTAMP_FORMAT, ChartData, ChartRenderer, chart_filename
+
+# Synthetic graph data of a batch of num_entries entries, one every 6 hours, in the layout of graphs.load_graph_data
+def synthetic_batch(num_entries, seed=0):
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    start = dt.datetime(2024, 5, 27, 12, 52, 10)
+    entry_data = pd.DataFrame({
+        'id': np.arange(1, num_entries + 1),
+        'timestamp': [(start + dt.timedelta(hours=6 * i)).strftime(ENV_TIMESTAMP_FORMAT) for i in range(num_entries)],
+        'temperature': rng.normal(22, 2, num_entries).round(1),
+        'humidity': rng.normal(60, 8, num_entries).round(1),
+        'average_height': np.maximum(np.linspace(0, 4, num_entries) + rng.normal(0, 0.2, num_entries), 0).round(2)
+    })
+    batch_data = pd.DataFrame([{'id': 1, 'optimum_entry_id': int(np.argmin(np.abs(entry_data['average_height'] - 2))) + 1}])
+    return ChartData(batch_data, entry_data)
+
+# The renderer used before the artists were kept: one figure cleared and drawn again for every graph
+class BaselineChartRenderer:
+    def __init__(self, figsize=(14, 8)):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        self.figure = Figure(figsize=figsize)
+        self.canvas = FigureCanvasAgg(self.figure)
+
+    def render(self, spec, data, outputs):
+        import matplotlib.dates as mdates
+        figure = self.figure
+        figure.clear()
+        ax1 = figure.add_subplot()
+        axes = [ax1]
+        lines = []
+        dual_axis = len(spec['series']) > 1
+        for i, series in enumerate(spec['series']):
+            if i > 0:
+                axes.append(ax1.twinx())
+            ax = axes[i]
+            line, = ax.plot(data.timestamps, data.columns[series['column']], color=series['color'],
+                            marker=series.get('marker'), label=series['label'])
+            lines.append(line)
+            if dual_axis:
+                ax.set_ylabel(series['ylabel'], color=series['color'])
+                ax.tick_params(axis='y', labelcolor=series['color'])
+            else:
+                ax.set_ylabel(series['ylabel'])
+        ax1.set_xlabel('Timestamp')
+        ax1.xaxis.set_major_locator(mdates.AutoDateLocator(maxticks=20))
+        ax1.xaxis.set_major_formatter(mdates.DateFormatter('%d-%m-%Y %H:%M'))
+        ax1.set_title(spec['title'])
+        ax1.grid(True)
+        if spec['optimum_color'] and data.optimum_height is not None:
+            height_axis = axes[[series['column'] for series in spec['series']].index('average_height')]
+            optimum_line = height_axis.axhline(y=data.optimum_height, color=spec['optimum_color'], linestyle='--',
+                                               label=f'Optimum Height: {data.optimum_height:.2f} cm at {data.optimum_timestamp}')
+            height_axis.text(data.timestamps[-1], data.optimum_height, f'Optimum Height: {data.optimum_height:.2f} cm',
+                             color=spec['optimum_color'], fontsize=12, ha='right', va='bottom')
+            if not dual_axis:
+                lines.append(optimum_line)
+        if dual_axis:
+            figure.autofmt_xdate()
+        else:
+            for label in ax1.get_xticklabels():
+                label.set_rotation(45)
+        ax1.legend(lines, [line.get_label() for line in lines], loc='upper left' if dual_axis else 'best')
+        figure.tight_layout()
+        for path, dpi in outputs:
+            figure.savefig(path, dpi=dpi)
+
+# Render the four graphs (and their thumbnails) of each batch in turn with one renderer, as a rendering thread does
+# Returns the mean time per batch in milliseconds, without the first batch (which creates the figures)
+def run_renderer(renderer, batches, output_dir, dpi, thumbnail_dpi):
+    times = []
+    for data in batches:
+        start = time.perf_counter()
+        for spec in CHART_SPECS:
+            filename = chart_filename(spec['title'])
+            renderer.render(spec, data, [(os.path.join(output_dir, filename), dpi),
+                                         (os.path.join(output_dir, f'thumbnail_{filename}'), thumbnail_dpi)])
+        times.append(time.perf_counter() - start)
+    return np.mean(times[1:]) * 1000
+
+# Compare the time to render the graphs of a batch with the previous and the current renderer
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rendering of the batch graphs.")
+    parser.add_argument('--entries', type=int, nargs='+', default=[17, 200, 1000], help="entries per synthetic batch")
+    parser.add_argument('--batches', type=int, default=5, help="batches rendered per size (the first one is not timed)")
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--thumbnail-dpi', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for num_entries in args.entries:
+            batches = [synthetic_batch(num_entries, seed) for seed in range(max(args.batches, 2))]
+            baseline = run_renderer(BaselineChartRenderer(), batches, output_dir, args.dpi, args.thumbnail_dpi)
+            current = run_renderer(ChartRenderer(), batches, output_dir, args.dpi, args.thumbnail_dpi)
+            print(f"{num_entries} entries: baseline {baseline:.0f} ms, current {current:.0f} ms per batch "
+                  f"({baseline / current:.2f}x)")
+
+if __name__ == '__main__':
+    main()
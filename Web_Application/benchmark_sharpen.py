@@ -0,0 +1,77 @@
+import argparse
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import cv2
+import numpy as np
+
+# Default sample image: the first frame of Batch_1
+DEFAULT_IMAGE = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stemhealth', 'static',
+                                              'seedling_data', 'Batch_1', 'original_images', '*.png')))[:1]
+
+# The sharpening implementation used before the saturating uint8 arithmetic, for comparison
+def baseline_sharpen_image(image, kernel_size=(5, 5), sigma=1.0, amount=2.5):
+    blurred = cv2.GaussianBlur(image, kernel_size, sigma)
+    sharpened = float(amount + 1) * image - float(amount) * blurred
+    sharpened = np.maximum(sharpened, np.zeros(sharpened.shape))
+    sharpened = np.minimum(sharpened, 255 * np.ones(sharpened.shape))
+    return sharpened.round().astype(np.uint8)
+
+# Sharpen an image repeatedly with one implementation, in this process
+# Returns the mean time per image in milliseconds and the peak RSS growth in MB
+def run_implementation(implementation, image_path, repeat):
+    image = cv2.imread(image_path)
+    if implementation == 'baseline':
+        sharpen = baseline_sharpen_image
+    else:
+        from stemhealth.util import sharpen_image
+        blurred = np.empty_like(image)
+        out = np.empty_like(image)
+        sharpen = lambda image: sharpen_image(image, blurred=blurred, out=out)
+    # ru_maxrss is in KiB on Linux
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for _ in range(repeat):
+        sharpen(image)
+    elapsed = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'ms': elapsed / repeat * 1000, 'rss_mb': (rss_after - rss_before) / 1024}
+
+# Run each implementation in a fresh interpreter, so the peak RSS of one does not hide the other
+def measure(implementation, image_path, repeat):
+    # An in-memory database, so importing the application does not change site.db
+    env = dict(os.environ, STEMHEALTH_DATABASE_URI='sqlite:///:memory:')
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', implementation, '--image', image_path,
+                             '--repeat', str(repeat)],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+    return json.loads(result.stdout)
+
+# Compare the time per image and the peak memory growth of the current and the previous sharpening
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sharpening of uploaded images.")
+    parser.add_argument('--image', default=DEFAULT_IMAGE[0] if DEFAULT_IMAGE else None, help="image to sharpen")
+    parser.add_argument('--repeat', type=int, default=20, help="number of times the image is sharpened")
+    parser.add_argument('--run', choices=['baseline', 'current'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if not args.image:
+        parser.error("no sample image found, pass --image")
+
+    if args.run:
+        print(json.dumps(run_implementation(args.run, args.image, args.repeat)))
+        return
+
+    baseline = measure('baseline', args.image, args.repeat)
+    current = measure('current', args.image, args.repeat)
+    print(f"{os.path.basename(args.image)}, {args.repeat} runs")
+    print(f"  baseline: {baseline['ms']:.1f} ms per image, peak RSS growth {baseline['rss_mb']:.1f} MB")
+    print(f"  current:  {current['ms']:.1f} ms per image, peak RSS growth {current['rss_mb']:.1f} MB")
+    print(f"  speedup:  {baseline['ms'] / current['ms']:.1f}x")
+
+if __name__ == '__main__':
+    main()
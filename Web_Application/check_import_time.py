@@ -0,0 +1,55 @@
+import argparse
+import os
+import subprocess
+import sys
+
+# Modules that must only be imported on first use (by a measurement job, a graph render or a Parquet export)
+LAZY_MODULES = ('torch', 'ultralytics', 'matplotlib', 'pandas', 'pyarrow', 'onnx', 'onnxruntime', 'openvino')
+# Default budget for importing the application, in milliseconds
+DEFAULT_BUDGET_MS = 1000
+
+# Import the application in a fresh interpreter with "python -X importtime"
+# Returns the cumulative import time of each top-level module, in microseconds
+def measure_import_times(module):
+    # An in-memory database, so importing the application does not change site.db
+    env = dict(os.environ, STEMHEALTH_DATABASE_URI='sqlite:///:memory:')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        import_times[name.strip()] = int(cumulative)
+    return import_times
+
+# Check the import time of the application against a budget, and that the heavy dependencies are not imported with it
+def main():
+    parser = argparse.ArgumentParser(description="Check the time taken to import the web application.")
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS, help="maximum import time in milliseconds")
+    parser.add_argument('--module', default='stemhealth', help="module to import")
+    args = parser.parse_args()
+
+    import_times = measure_import_times(args.module)
+    total_ms = import_times[args.module] / 1000
+    slowest = sorted(((name, time) for name, time in import_times.items() if '.' not in name and name != args.module),
+                     key=lambda item: item[1], reverse=True)[:10]
+    print(f"import {args.module}: {total_ms:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    for name, time in slowest:
+        print(f"  {name}: {time / 1000:.0f} ms")
+
+    failed = False
+    eager = [name for name in LAZY_MODULES if name in import_times]
+    if eager:
+        print(f"Imported at startup, should be imported on first use: {', '.join(eager)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"Import time is over budget by {total_ms - args.budget_ms:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 import os
+import sqlite3
 
 app = Flask(__name__)
 
@@ -10,12 +13,81 @@ project_root = os.path.dirname(os.path.abspath(__file__))
 # Define the upload folder relative to the project root
 UPLOAD_FOLDER = os.path.join(app.static_folder, 'seedling_data')
 
-# Configure the database URI relative to the project root
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(project_root, "site.db")}'
+# Configure the database URI relative to the project root (STEMHEALTH_DATABASE_URI overrides it, e.g. for the tests)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('STEMHEALTH_DATABASE_URI', f'sqlite:///{os.path.join(project_root, "site.db")}')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'
 
+# Model weights available for measurement (relative to the static folder), selectable per batch
+app.config['MODEL_VERSIONS'] = {'default': 'model/best.pt'}
+app.config['DEFAULT_MODEL_VERSION'] = 'default'
+# Number of batches shown per dashboard page
+app.config['DASHBOARD_PAGE_SIZE'] = 24
+# Number of entries shown per page on the batch profile page, and the most a client can request
+app.config['ENTRIES_PAGE_SIZE'] = 60
+app.config['ENTRIES_PAGE_SIZE_MAX'] = 500
+# Resolution of the batch graphs and of the previews shown on the batch profile page
+app.config['GRAPH_DPI'] = 100
+app.config['GRAPH_THUMBNAIL_DPI'] = 50
+# Most points a client can request from the time-series API after downsampling
+app.config['SERIES_MAX_POINTS'] = 10000
+# Number of rows read from the database at a time when exporting a batch
+app.config['EXPORT_CHUNK_SIZE'] = 5000
+# Store the measured seedlings of each entry as a compact blob on the entry instead of IndividualHeight rows
+app.config['COMPACT_DETECTIONS'] = False
+# Cache the raw detections of the model per image, so they can be measured again with stricter confidence and IoU
+# thresholds (or another measurement geometry) without running the model. The model then predicts with the looser
+# thresholds below, which finds more boxes (and masks) per image and makes predictions slower. The measurement
+# thresholds are then applied to the cached boxes, which only approximates a prediction with them (the entries are
+# marked as refiltered). Changing these settings measures the entries again on the next prediction
+app.config['RAW_DETECTION_CACHE'] = False
+app.config['RAW_DETECTION_CONF'] = 0.1
+app.config['RAW_DETECTION_IOU'] = 0.9
+# Only predict the region of the frames around the eligible area (widened by ROI_MARGIN pixels), at the image size
+# ROI_IMAGE_SIZE, or at the scale of the full frames if None
+app.config['ROI_INFERENCE'] = False
+app.config['ROI_MARGIN'] = 64
+app.config['ROI_IMAGE_SIZE'] = None
+# Most detections the model keeps per image
+app.config['MAX_DETECTIONS'] = 1000
+# Number of images sent to the model at once, bounding the memory used by the results
+app.config['INFERENCE_BATCH_SIZE'] = 8
+# Number of threads torch uses for a single inference (None keeps the torch default)
+app.config['TORCH_THREADS'] = None
+# Address of the inference server ("host:port" or a Unix socket path), None to run the model in this process
+app.config['INFERENCE_SERVER_ADDRESS'] = None
+# Key authenticating the web application to the inference server, from the STEMHEALTH_INFERENCE_KEY environment
+# variable or the file STEMHEALTH_INFERENCE_KEY_FILE points to (never from this file, which is public)
+app.config['INFERENCE_SERVER_KEY'] = os.environ.get('STEMHEALTH_INFERENCE_KEY')
+app.config['INFERENCE_SERVER_KEY_FILE'] = os.environ.get('STEMHEALTH_INFERENCE_KEY_FILE')
+# Allow a "host:port" inference server address on another host than the loopback interface
+app.config['INFERENCE_SERVER_ALLOW_REMOTE'] = False
+# Most images the inference server runs at once, and how long it waits for more images to fill a batch
+app.config['INFERENCE_SERVER_BATCH_SIZE'] = 16
+app.config['INFERENCE_SERVER_MAX_WAIT_MS'] = 20
+# Number of processes sharpening uploaded images
+app.config['PREPROCESS_WORKERS'] = os.cpu_count() or 1
+# Number of background threads running measurement jobs
+app.config['JOB_WORKERS'] = 2
+# Seconds after which an unfinished job whose process stopped reporting on it is considered abandoned
+app.config['JOB_HEARTBEAT_TIMEOUT'] = 120
+
+# SQLite page cache size per connection, in KiB
+app.config['SQLITE_CACHE_SIZE_KB'] = 64 * 1024
+
 db = SQLAlchemy(app)
 
+# Tune every SQLite connection: WAL lets readers run alongside the measurement writes
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f"PRAGMA cache_size=-{app.config['SQLITE_CACHE_SIZE_KB']}")
+        cursor.close()
+
 from stemhealth.models import Batch, Entry
+
 from stemhealth import routes
+from stemhealth import cli
@@ -0,0 +1,164 @@
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from stemhealth import app
+from stemhealth import pipeline
+
+# Inference backends the model can be exported to and run with on CPU (ultralytics runs an exported model with its
+# runtime when its path is set in MODEL_VERSIONS), and the precisions each one can be exported at
+# ONNX Runtime INT8 models have dynamically quantized weights; OpenVINO INT8 models are calibrated on seedling images
+BACKEND_PRECISIONS = {
+    'onnx': ('fp32', 'int8'),
+    'openvino': ('fp32', 'fp16', 'int8')
+}
+# Boxes of two models overlapping by at least this IoU are considered the same detection
+MATCH_IOU = 0.5
+
+# Copy the metadata ultralytics reads from an ONNX model (task, class names, image size, ...) to another ONNX model
+def copy_onnx_metadata(source_path, target_path):
+    import onnx
+    source = onnx.load(source_path)
+    target = onnx.load(target_path)
+    onnx.helper.set_model_props(target, {prop.key: prop.value for prop in source.metadata_props})
+    onnx.save(target, target_path)
+
+# Export the weights of a model version to an inference backend, next to the weights
+# Exported models take any batch and image size, as measurements predict micro-batches and regions of the frames
+# INT8 OpenVINO models are calibrated on the images of calibration_dir
+# Returns the path of the exported model
+def export_model(model_version, backend, precision, calibration_dir=None):
+    if precision not in BACKEND_PRECISIONS[backend]:
+        raise ValueError(f"{backend} models can be exported as: {', '.join(BACKEND_PRECISIONS[backend])}")
+    from ultralytics import YOLO
+    from stemhealth import inference
+    model = YOLO(inference.get_model_path(model_version))
+
+    if backend == 'onnx':
+        exported_path = model.export(format='onnx', dynamic=True, simplify=True)
+        if precision == 'int8':
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantized_path = f"{os.path.splitext(exported_path)[0]}_int8.onnx"
+            quantize_dynamic(exported_path, quantized_path, weight_type=QuantType.QUInt8)
+            copy_onnx_metadata(exported_path, quantized_path)
+            exported_path = quantized_path
+        return exported_path
+
+    if precision != 'int8':
+        return model.export(format='openvino', dynamic=True, half=precision == 'fp16')
+    if not calibration_dir:
+        raise ValueError("INT8 OpenVINO models need calibration images")
+    # Describe the calibration images as a dataset (JSON is valid YAML)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_path = os.path.join(temp_dir, 'calibration.yaml')
+        with open(data_path, 'w') as f:
+            json.dump({'path': os.path.abspath(calibration_dir), 'train': '.', 'val': '.', 'names': model.names}, f)
+        return model.export(format='openvino', dynamic=True, int8=True, data=data_path)
+
+# Predict images with a model the way measurements do, in micro-batches with the measurement thresholds
+# Returns the detections of each image and the seconds spent predicting
+def timed_predictions(loaded, paths, conf, iou):
+    batch_size = app.config['INFERENCE_BATCH_SIZE']
+    detections = []
+    start = time.perf_counter()
+    for i in range(0, len(paths), batch_size):
+        detections.extend(loaded.predict(paths[i:i + batch_size], conf, iou))
+    return detections, time.perf_counter() - start
+
+# Match the boxes of two sets of detections of the same class one to one, most overlapping first
+# Returns the (reference index, candidate index, IoU) of the pairs overlapping by at least min_iou
+def match_boxes(reference, candidate, min_iou=MATCH_IOU):
+    a = np.asarray(reference['xyxy'], dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(candidate['xyxy'], dtype=np.float64).reshape(-1, 4)
+    if not len(a) or not len(b):
+        return []
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    ious = intersection / np.maximum(area_a[:, None] + area_b[None, :] - intersection, 1e-9)
+    ious[np.asarray(reference['cls'])[:, None] != np.asarray(candidate['cls'])[None, :]] = 0
+
+    pairs = []
+    matched_a = set()
+    matched_b = set()
+    for flat_index in np.argsort(-ious, axis=None, kind='stable'):
+        i, j = divmod(int(flat_index), ious.shape[1])
+        if ious[i, j] < min_iou:
+            break
+        if i in matched_a or j in matched_b:
+            continue
+        matched_a.add(i)
+        matched_b.add(j)
+        pairs.append((i, j, float(ious[i, j])))
+    return pairs
+
+# Compare a candidate model version (e.g. an exported backend) against a reference model version on the images
+# of a batch: the speed of the predictions, the boxes detected and the heights measured from them
+# Both models predict one micro-batch before the timing starts (loading weights, compiling and allocating happen on
+# the first prediction), then the batch is predicted repeat times by each model, alternating which one goes first,
+# and the median time of each model is reported
+def compare_models(reference_version, candidate_version, batch, conf=pipeline.PREDICT_CONF, iou=pipeline.PREDICT_IOU,
+                   repeat=3):
+    from stemhealth import inference
+    reference_model = inference.get_model(reference_version)
+    candidate_model = inference.get_model(candidate_version)
+    _, geometry, _ = pipeline.get_batch_geometry(batch)
+    paths = [os.path.join(app.static_folder, entry.original_image_filepath) for entry in batch.entries]
+
+    warm_up_paths = paths[:app.config['INFERENCE_BATCH_SIZE']]
+    timed_predictions(reference_model, warm_up_paths, conf, iou)
+    timed_predictions(candidate_model, warm_up_paths, conf, iou)
+    reference_times = []
+    candidate_times = []
+    for run in range(max(repeat, 1)):
+        if run % 2 == 0:
+            reference_detections, reference_run_seconds = timed_predictions(reference_model, paths, conf, iou)
+            candidate_detections, candidate_run_seconds = timed_predictions(candidate_model, paths, conf, iou)
+        else:
+            candidate_detections, candidate_run_seconds = timed_predictions(candidate_model, paths, conf, iou)
+            reference_detections, reference_run_seconds = timed_predictions(reference_model, paths, conf, iou)
+        reference_times.append(reference_run_seconds)
+        candidate_times.append(candidate_run_seconds)
+    reference_seconds = float(np.median(reference_times))
+    candidate_seconds = float(np.median(candidate_times))
+
+    reference_boxes = 0
+    candidate_boxes = 0
+    ious = []
+    eligibility_changes = 0
+    height_deltas = []
+    average_height_deltas = []
+    for reference, candidate in zip(reference_detections, candidate_detections):
+        reference_eligible, reference_heights = geometry.measure_boxes(reference['xyxy'])
+        candidate_eligible, candidate_heights = geometry.measure_boxes(candidate['xyxy'])
+        reference_boxes += len(reference['conf'])
+        candidate_boxes += len(candidate['conf'])
+        for i, j, box_iou in match_boxes(reference, candidate):
+            ious.append(box_iou)
+            if reference_eligible[i] != candidate_eligible[j]:
+                eligibility_changes += 1
+            elif reference_eligible[i]:
+                height_deltas.append(abs(reference_heights[i] - candidate_heights[j]))
+        # Difference of the average height the entry would get
+        average_height_deltas.append(abs(pipeline.average_height(reference_heights[reference_eligible].tolist()) -
+                                         pipeline.average_height(candidate_heights[candidate_eligible].tolist())))
+
+    return {
+        'images': len(paths),
+        'runs': len(reference_times),
+        'reference_seconds': reference_seconds,
+        'candidate_seconds': candidate_seconds,
+        'speedup': reference_seconds / candidate_seconds if candidate_seconds else None,
+        'reference_boxes': reference_boxes,
+        'candidate_boxes': candidate_boxes,
+        'matched_boxes': len(ious),
+        'mean_iou': float(np.mean(ious)) if ious else None,
+        'eligibility_changes': eligibility_changes,
+        'mean_height_delta': float(np.mean(height_deltas)) if height_deltas else None,
+        'max_height_delta': float(np.max(height_deltas)) if height_deltas else None,
+        'mean_average_height_delta': float(np.mean(average_height_deltas)) if average_height_deltas else None,
+        'max_average_height_delta': float(np.max(average_height_deltas)) if average_height_deltas else None
+    }
@@ -0,0 +1,161 @@
+import json
+import os
+import click
+from werkzeug.datastructures import FileStorage
+from stemhealth import app, db
+from stemhealth.models import Batch
+from stemhealth import pipeline
+from stemhealth.backends import BACKEND_PRECISIONS, compare_models, export_model
+from stemhealth.ingest import ALLOWED_IMAGE_EXTENSIONS, add_entries, make_batch_dirs
+from stemhealth.jobs import Job
+from stemhealth.queries import invalidate_batch_stats
+from stemhealth.schema import upgrade_schema
+from stemhealth.util import allowed_file, calculate_optimum_duration, index_environmental_data
+
+# Command line interface, run with "flask --app app <command>" from the Web_Application folder
+
+# Command for creating the tables and upgrading the schema of the database, to run once after an update before
+# starting the application with "flask run" or a WSGI server ("python app.py" does it itself)
+@app.cli.command('upgrade-db', help="Create the missing tables, columns and indexes of the database.")
+def upgrade_db():
+    db.create_all()
+    for table, column in upgrade_schema():
+        click.echo(f"Added the column {table}.{column}")
+    click.echo("The database is up to date.")
+
+# Command for appending new frames to an existing batch, e.g. from a capture rig
+@app.cli.command('append-frames', help="Append IMAGES and their environmental data to the batch BATCH_NAME.")
+@click.argument('batch_name')
+@click.argument('images', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--env', 'env_data_path', required=True, type=click.Path(exists=True, dir_okay=False),
+              help='JSON file with the environmental data of the images.')
+@click.option('--measure', is_flag=True, help='Measure the new frames once they are added.')
+def append_frames(batch_name, images, env_data_path, measure):
+    batch = Batch.query.filter_by(name_key=Batch.normalize_name(batch_name)).first()
+    if batch is None:
+        raise click.ClickException(f"No batch named '{batch_name}'")
+    invalid_images = [path for path in images if not allowed_file(path, ALLOWED_IMAGE_EXTENSIONS)]
+    if invalid_images:
+        raise click.ClickException(f"Only PNG, JPG, and JPEG files are allowed: {', '.join(invalid_images)}")
+    with open(env_data_path, 'r') as json_file:
+        env_index = index_environmental_data(json.load(json_file))
+
+    # Store the new frames, then update the optimum duration and statistics of the batch
+    image_files = [FileStorage(stream=open(path, 'rb'), filename=os.path.basename(path)) for path in images]
+    try:
+        num_added, failed_images, missing_env_data, duplicates = add_entries(batch, image_files, env_index)
+    finally:
+        for file in image_files:
+            file.close()
+    if num_added:
+        calculate_optimum_duration(batch)
+    db.session.commit()
+    invalidate_batch_stats(batch.id)
+
+    click.echo(f"Added {num_added} frame(s) to {batch.name}.")
+    for filename, error in failed_images:
+        click.echo(f"{filename} could not be processed: {error}", err=True)
+    if missing_env_data:
+        click.echo(f"No environmental data was found for: {', '.join(missing_env_data)}", err=True)
+    if duplicates:
+        click.echo(f"Already in the batch: {', '.join(duplicates)}")
+
+    # Measure the new frames in this process (only entries that were not measured before are processed)
+    if measure and num_added:
+        job = Job('measure', batch.id)
+        pipeline.measure_batch(job, batch.id)
+        click.echo(f"Measured {job.processed} frame(s).")
+        for error in job.errors:
+            click.echo(f"Entry {error['entry_id']}: {error['error']}", err=True)
+
+# Command for measuring a batch again from the raw detections cached by its last predictions, without the model
+@app.cli.command('remeasure', help="Measure the batch BATCH_NAME again from its cached detections with other thresholds.")
+@click.argument('batch_name')
+@click.option('--conf', type=click.FloatRange(0, 1), default=pipeline.PREDICT_CONF, show_default=True,
+              help='Confidence threshold (no lower than the one the detections were cached with).')
+@click.option('--iou', type=click.FloatRange(0, 1), default=pipeline.PREDICT_IOU, show_default=True,
+              help='IoU threshold of the non-maximum suppression (no higher than the one the detections were cached with).')
+def remeasure(batch_name, conf, iou):
+    batch = Batch.query.filter_by(name_key=Batch.normalize_name(batch_name)).first()
+    if batch is None:
+        raise click.ClickException(f"No batch named '{batch_name}'")
+    job = Job('measure', batch.id)
+    pipeline.measure_batch(job, batch.id, from_cache=True, conf=conf, iou=iou)
+    click.echo(f"Measured {job.processed} entr{'y' if job.processed == 1 else 'ies'} of {batch.name}.")
+    for error in job.errors:
+        click.echo(f"Entry {error['entry_id']}: {error['error']}", err=True)
+
+# Command for comparing thresholds on a batch from its cached detections, without storing the measurements
+@app.cli.command('sweep-thresholds', help="Measure the batch BATCH_NAME from its cached detections with each combination "
+                                          "of the given thresholds and print the results, without storing them.")
+@click.argument('batch_name')
+@click.option('--conf', 'confs', type=click.FloatRange(0, 1), multiple=True, help='Confidence threshold (repeatable).')
+@click.option('--iou', 'ious', type=click.FloatRange(0, 1), multiple=True, help='IoU threshold (repeatable).')
+def sweep_thresholds(batch_name, confs, ious):
+    batch = Batch.query.filter_by(name_key=Batch.normalize_name(batch_name)).first()
+    if batch is None:
+        raise click.ClickException(f"No batch named '{batch_name}'")
+    thresholds = [(conf, iou) for conf in confs or (pipeline.PREDICT_CONF,) for iou in ious or (pipeline.PREDICT_IOU,)]
+    results = pipeline.sweep_batch(batch.id, thresholds)
+
+    click.echo(f"{'conf':>6} {'iou':>6} {'entries':>8} {'seedlings':>10} {'avg height (cm)':>16}")
+    for result in results:
+        average_height = 'n/a' if result['average_height'] is None else f"{result['average_height']:.2f}"
+        click.echo(f"{result['conf']:>6.2f} {result['iou']:>6.2f} {result['entries']:>8} {result['seedlings']:>10} {average_height:>16}")
+
+# Command for exporting the model to an inference backend, to be added to MODEL_VERSIONS
+@app.cli.command('export-model', help="Export the model to ONNX (run with ONNX Runtime) or OpenVINO.")
+@click.option('--backend', type=click.Choice(list(BACKEND_PRECISIONS)), required=True)
+@click.option('--precision', type=click.Choice(['fp32', 'fp16', 'int8']), default='fp32', show_default=True,
+              help='FP16 is only available with OpenVINO.')
+@click.option('--model', 'model_version', default=None, help='Model version to export (the default model if not given).')
+@click.option('--calibration-batch', default=None, help='Batch whose images calibrate an INT8 OpenVINO model.')
+def export_model_command(backend, precision, model_version, calibration_batch):
+    calibration_dir = None
+    if calibration_batch:
+        batch = Batch.query.filter_by(name_key=Batch.normalize_name(calibration_batch)).first()
+        if batch is None:
+            raise click.ClickException(f"No batch named '{calibration_batch}'")
+        _, calibration_dir, _ = make_batch_dirs(batch.name)
+    try:
+        exported_path = export_model(model_version, backend, precision, calibration_dir)
+    except (KeyError, ValueError) as e:
+        raise click.ClickException(str(e))
+    relative_path = os.path.relpath(exported_path, app.static_folder).replace('\\', '/')
+    click.echo(f"Exported to {exported_path}")
+    click.echo(f"Add it to MODEL_VERSIONS to use it, e.g. '{backend}-{precision}': '{relative_path}'")
+
+# Format an optional number of a report
+def format_number(value, unit=''):
+    return 'n/a' if value is None else f"{value:.3f}{unit}"
+
+# Command for checking a model version (e.g. an exported backend) against the reference model on sample batches
+@app.cli.command('compare-models', help="Compare the predictions and heights of the model version CANDIDATE with "
+                                        "the reference model on the images of sample batches.")
+@click.argument('candidate')
+@click.option('--reference', default=None, help='Reference model version (the default model if not given).')
+@click.option('--batch', 'batch_names', multiple=True, default=('Batch 1', 'Batch 2'), show_default=True,
+              help='Batch to compare on (repeatable).')
+@click.option('--repeat', default=3, show_default=True, type=click.IntRange(min=1),
+              help='Number of timed runs per model, the median time is reported.')
+def compare_models_command(candidate, reference, batch_names, repeat):
+    reference = reference or app.config['DEFAULT_MODEL_VERSION']
+    for version in (reference, candidate):
+        if version not in app.config['MODEL_VERSIONS']:
+            raise click.ClickException(f"Unknown model version: {version}")
+
+    for batch_name in batch_names:
+        batch = Batch.query.filter_by(name_key=Batch.normalize_name(batch_name)).first()
+        if batch is None or not batch.entries:
+            click.echo(f"Skipping '{batch_name}': no such batch or no entries", err=True)
+            continue
+        result = compare_models(reference, candidate, batch, repeat=repeat)
+        click.echo(f"{batch.name} ({result['images']} images): {reference} vs {candidate}")
+        click.echo(f"  time (median of {result['runs']} runs): {result['reference_seconds']:.2f} s vs "
+                   f"{result['candidate_seconds']:.2f} s ({format_number(result['speedup'], 'x')} speedup)")
+        click.echo(f"  boxes: {result['reference_boxes']} vs {result['candidate_boxes']}, {result['matched_boxes']} matched "
+                   f"(mean IoU {format_number(result['mean_iou'])}), {result['eligibility_changes']} changed eligibility")
+        click.echo(f"  seedling height delta: mean {format_number(result['mean_height_delta'], ' cm')}, "
+                   f"max {format_number(result['max_height_delta'], ' cm')}")
+        click.echo(f"  entry average height delta: mean {format_number(result['mean_average_height_delta'], ' cm')}, "
+                   f"max {format_number(result['max_average_height_delta'], ' cm')}")
@@ -0,0 +1,116 @@
+import json
+import os
+import cv2
+import numpy as np
+
+# Compact storage of the measured seedlings of an entry (enabled with COMPACT_DETECTIONS): instead of one
+# IndividualHeight row per seedling, the entry stores its seedlings as packed records in a blob column
+# and the names of their labels, indexed by label_id, as a JSON list
+DETECTION_DTYPE = np.dtype([
+    ('height', '<f4'),
+    ('confidence', '<f4'),
+    ('x1', '<i2'),
+    ('y1', '<i2'),
+    ('x2', '<i2'),
+    ('y2', '<i2'),
+    ('label_id', '<u2')
+])
+
+# Pack individual height rows (as inserted into the IndividualHeight table) into a blob and a JSON label list
+def pack_detections(individual_heights):
+    labels = list(dict.fromkeys(row['label'] for row in individual_heights))
+    label_ids = {label: i for i, label in enumerate(labels)}
+    records = np.empty(len(individual_heights), dtype=DETECTION_DTYPE)
+    for i, row in enumerate(individual_heights):
+        records[i] = (row['height'], row['confidence'], row['x1'], row['y1'], row['x2'], row['y2'], label_ids[row['label']])
+    return records.tobytes(), json.dumps(labels)
+
+# Get the packed records of a blob as a read-only array sharing the blob's memory (no copy)
+def load_detections(blob):
+    if not blob:
+        return np.empty(0, dtype=DETECTION_DTYPE)
+    return np.frombuffer(blob, dtype=DETECTION_DTYPE)
+
+# Heights of packed records as float64, rounded back to the 2 decimals they were measured with
+def detection_heights(records):
+    return np.round(records['height'].astype(np.float64), 2)
+
+# Convert the packed records of an entry to dictionaries in the format of IndividualHeight.to_dict
+# (compact detections have no row ID)
+def detections_to_dicts(entry_id, blob, labels_json):
+    records = load_detections(blob)
+    labels = json.loads(labels_json) if labels_json else []
+    heights = detection_heights(records).tolist()
+    confidences = records['confidence'].astype(np.float64).tolist()
+    return [{
+        'id': None,
+        'height': heights[i],
+        'label': labels[record['label_id']],
+        'confidence': confidences[i],
+        'x1': int(record['x1']),
+        'y1': int(record['y1']),
+        'x2': int(record['x2']),
+        'y2': int(record['y2']),
+        'entry_id': entry_id
+    } for i, record in enumerate(records)]
+
+# Apply the confidence and IoU thresholds to detections predicted with the looser raw_conf and raw_iou:
+# boxes not above conf are dropped, then boxes overlapping a more confident box of the same class by more than iou
+# are suppressed. Thresholds looser than the raw ones cannot bring back boxes the model already dropped
+# This approximates a prediction with (conf, iou) but is not identical: the model suppressed overlapping boxes at
+# raw_iou before (and max_det after) its raw_conf threshold, so a box can be kept or dropped differently
+def filter_detections(detections, conf, iou, raw_conf, raw_iou):
+    if conf <= raw_conf and iou >= raw_iou:
+        return detections
+    keep = np.flatnonzero(detections['conf'] > conf)
+    if iou < raw_iou and len(keep) > 1:
+        xyxy = detections['xyxy'][keep].astype(np.float64)
+        boxes = np.column_stack((xyxy[:, :2], xyxy[:, 2:] - xyxy[:, :2]))
+        kept = cv2.dnn.NMSBoxesBatched(boxes.tolist(), detections['conf'][keep].tolist(),
+                                       detections['cls'][keep].tolist(), 0.0, float(iou))
+        # Keep the order of the model (most confident first)
+        keep = keep[np.sort(np.asarray(kept, dtype=np.int64).reshape(-1))]
+    return {**detections, 'xyxy': detections['xyxy'][keep], 'conf': detections['conf'][keep], 'cls': detections['cls'][keep]}
+
+# Cache of the raw detections of the model, keyed by image hash and model version, so the measurement thresholds
+# and geometry can be applied again without running the model
+class RawDetectionCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, image_hash, model_version):
+        return os.path.join(self.cache_dir, f"{image_hash[:32]}_{model_version}.npz")
+
+    # Store the detections of an image with the class names of the model and the thresholds they were predicted with
+    def save(self, image_hash, model_version, detections, names, raw_conf, raw_iou):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(image_hash, model_version)
+        # Write to a temporary file first so a concurrent reader never sees a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez(f,
+                     xyxy=np.asarray(detections['xyxy'], dtype=np.float32).reshape(-1, 4),
+                     conf=np.asarray(detections['conf'], dtype=np.float32),
+                     cls=np.asarray(detections['cls'], dtype=np.int32),
+                     names=np.array(json.dumps({str(k): v for k, v in names.items()})),
+                     thresholds=np.array([raw_conf, raw_iou], dtype=np.float64))
+        os.replace(temp_path, path)
+
+    # Load the cached detections of an image, None if it was not predicted with this model version
+    # The detections carry the class names ('names') and the thresholds they were predicted with ('thresholds')
+    def load(self, image_hash, model_version):
+        if not image_hash or not model_version:
+            return None
+        try:
+            data = np.load(self.path(image_hash, model_version))
+        except FileNotFoundError:
+            return None
+        with data:
+            raw_conf, raw_iou = data['thresholds'].tolist()
+            return {
+                'xyxy': data['xyxy'],
+                'conf': data['conf'],
+                'cls': data['cls'].astype(int),
+                'names': {int(k): v for k, v in json.loads(str(data['names'])).items()},
+                'thresholds': (raw_conf, raw_iou)
+            }
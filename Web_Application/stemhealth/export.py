@@ -0,0 +1,162 @@
+import csv
+import datetime as dt
+import importlib.util
+import io
+import zlib
+from sqlalchemy import select
+from stemhealth import app, db
+from stemhealth.models import Batch, Entry, IndividualHeight
+from stemhealth.detections import detections_to_dicts
+
+# Timestamp format of the exported entries (the format of the environmental data)
+EXPORT_TIMESTAMP_FORMAT = "%d-%m-%Y_%H-%M-%S"
+
+# Number of entries whose compact detections are read from the database at a time
+COMPACT_ENTRIES_PER_READ = 100
+
+# Columns of each exported table
+EXPORT_COLUMNS = {
+    'batch': ('id', 'name', 'species', 'optimum_duration', 'optimum_entry_id'),
+    'entry': ('id', 'original_image_filepath', 'timestamp', 'temperature', 'humidity', 'predicted_image_filepath',
+              'predicted_seedlings', 'average_height', 'batch_id'),
+    'individual_height': ('id', 'height', 'label', 'confidence', 'x1', 'y1', 'x2', 'y2', 'entry_id')
+}
+
+# Export formats: (file extension, MIME type)
+EXPORT_FORMATS = {
+    'csv': ('csv', 'text/csv'),
+    'csv.gz': ('csv.gz', 'application/gzip'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet')
+}
+
+# Parquet export is only offered when pyarrow is installed (it is imported by the first Parquet export)
+def available_formats():
+    has_pyarrow = importlib.util.find_spec('pyarrow') is not None
+    return [name for name in EXPORT_FORMATS if name != 'parquet' or has_pyarrow]
+
+def export_filename(batch, table, export_format):
+    return f"{batch.name.replace(' ', '_')}_{table}.{EXPORT_FORMATS[export_format][0]}"
+
+# Select the rows of a table of a batch, in ID order
+def export_statement(batch_id, table):
+    if table == 'batch':
+        return select(*[getattr(Batch, column) for column in EXPORT_COLUMNS['batch']]).where(Batch.id == batch_id)
+    if table == 'entry':
+        return (select(*[getattr(Entry, column) for column in EXPORT_COLUMNS['entry']])
+                .where(Entry.batch_id == batch_id)
+                .order_by(Entry.id))
+    return (select(*[getattr(IndividualHeight, column) for column in EXPORT_COLUMNS['individual_height']])
+            .join(Entry, IndividualHeight.entry_id == Entry.id)
+            .where(Entry.batch_id == batch_id)
+            .order_by(IndividualHeight.id))
+
+def format_value(value):
+    return value.strftime(EXPORT_TIMESTAMP_FORMAT) if isinstance(value, dt.datetime) else value
+
+# Read the rows of a table of a batch in chunks from the database cursor, so only one chunk is held in memory
+def iter_row_chunks(batch_id, table):
+    chunk_size = app.config['EXPORT_CHUNK_SIZE']
+    statement = export_statement(batch_id, table).execution_options(yield_per=chunk_size)
+    result = db.session.execute(statement)
+    try:
+        for rows in result.partitions(chunk_size):
+            yield [tuple(format_value(value) for value in row) for row in rows]
+    finally:
+        result.close()
+    # The seedlings of entries storing compact detections follow those stored as IndividualHeight rows
+    if table == 'individual_height':
+        yield from iter_compact_height_chunks(batch_id, chunk_size)
+
+# Read the seedlings of the entries of a batch storing compact detections, in chunks of about chunk_size rows
+def iter_compact_height_chunks(batch_id, chunk_size):
+    statement = (
+        select(Entry.id, Entry.detections, Entry.detection_labels)
+        .where(Entry.batch_id == batch_id, Entry.detections.isnot(None))
+        .order_by(Entry.id)
+        .execution_options(yield_per=COMPACT_ENTRIES_PER_READ)
+    )
+    rows = []
+    for entry_id, blob, labels_json in db.session.execute(statement):
+        for individual_height in detections_to_dicts(entry_id, blob, labels_json):
+            rows.append(tuple(individual_height[column] for column in EXPORT_COLUMNS['individual_height']))
+        if len(rows) >= chunk_size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+# Write the rows as CSV, one encoded chunk at a time
+# The first (unnamed) column numbers the rows, as in the CSV files previously written with pandas
+def iter_csv(batch_id, table):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(('',) + EXPORT_COLUMNS[table])
+    row_number = 0
+    for rows in iter_row_chunks(batch_id, table):
+        for row in rows:
+            writer.writerow((row_number,) + row)
+            row_number += 1
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+# Compress the CSV chunks into a single gzip stream
+def iter_csv_gzip(batch_id, table):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for data in iter_csv(batch_id, table):
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+# Write-only file handed to the Parquet writer, whose written bytes are taken out after each row group
+class ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+# Parquet schema of a table, from the column types of the models (timestamps are exported as formatted strings)
+def parquet_schema(table):
+    import pyarrow as pa
+    types = {int: pa.int64(), float: pa.float64(), str: pa.string(), dt.datetime: pa.string()}
+    return pa.schema([(column.name, types[column.type.python_type]) for column in export_statement(None, table).selected_columns])
+
+# Write the rows as Parquet, one row group per chunk
+def iter_parquet(batch_id, table):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = parquet_schema(table)
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for rows in iter_row_chunks(batch_id, table):
+        columns = {column: [row[i] for row in rows] for i, column in enumerate(EXPORT_COLUMNS[table])}
+        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+# Get the streamed content of an export of a table of a batch
+def iter_export(batch_id, table, export_format):
+    if export_format == 'parquet':
+        return iter_parquet(batch_id, table)
+    if export_format == 'csv.gz':
+        return iter_csv_gzip(batch_id, table)
+    return iter_csv(batch_id, table)
@@ -0,0 +1,111 @@
+import datetime as dt
+import hashlib
+import json
+import os
+import shutil
+from sqlalchemy import select
+from stemhealth import app, db
+from stemhealth.models import Entry
+from stemhealth.jobs import job_queue
+from stemhealth.util import CHART_SPECS, chart_columns, chart_filename, render_charts
+
+# Bump when the look of the graphs changes so every batch's graphs are re-rendered
+GRAPH_STYLE_VERSION = 2
+# File recording the data version each graph was rendered from
+VERSIONS_FILENAME = 'versions.json'
+
+# Folder (inside the graphs folder) holding the low-resolution previews shown on the page
+THUMBNAILS_FOLDER = 'thumbnails'
+
+def get_graphs_folder(batch):
+    return os.path.join(app.static_folder, 'seedling_data', batch.name.replace(' ', '_'), 'graphs_folder')
+
+# Load the graph data of a batch straight from the database, in the layout the plotting functions expect
+def load_graph_data(batch):
+    # pandas is imported on first use, so processes that never draw graphs do not load it
+    import pandas as pd
+    rows = db.session.execute(
+        select(Entry.id, Entry.timestamp, Entry.temperature, Entry.humidity, Entry.average_height)
+        .where(Entry.batch_id == batch.id)
+        .order_by(Entry.timestamp, Entry.id)
+    ).all()
+    entry_data = pd.DataFrame({
+        'id': [row.id for row in rows],
+        'timestamp': [dt.datetime.strftime(row.timestamp, "%d-%m-%Y_%H-%M-%S") for row in rows],
+        'temperature': [row.temperature for row in rows],
+        'humidity': [row.humidity for row in rows],
+        'average_height': [row.average_height for row in rows]
+    })
+    batch_data = pd.DataFrame([{'id': batch.id, 'optimum_entry_id': batch.optimum_entry_id}])
+    return batch_data, entry_data
+
+# Data version of a single graph: a hash of the data it is plotted from
+def graph_version(spec, batch_data, entry_data):
+    import pandas as pd
+    sha = hashlib.sha256(f"{GRAPH_STYLE_VERSION}:{spec['title']}".encode())
+    sha.update(pd.util.hash_pandas_object(entry_data[chart_columns(spec)], index=False).values.tobytes())
+    if spec['optimum_color']:
+        sha.update(str(batch_data['optimum_entry_id'].values[0]).encode())
+    return sha.hexdigest()[:16]
+
+def read_versions(graphs_folder):
+    try:
+        with open(os.path.join(graphs_folder, VERSIONS_FILENAME), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Job function rendering the stale graphs of a batch, replacing the served images only once each is complete
+def render_graphs(job, batch_id, batch_data, entry_data, graphs_folder, versions):
+    titles = [spec['title'] for spec in CHART_SPECS if chart_filename(spec['title']) in versions]
+    job.start(total=len(titles))
+    thumbnails_folder = os.path.join(graphs_folder, THUMBNAILS_FOLDER)
+    temp_folder = os.path.join(graphs_folder, f'.rendering_{job.id}')
+    temp_thumbnails_folder = os.path.join(temp_folder, THUMBNAILS_FOLDER)
+    os.makedirs(thumbnails_folder, exist_ok=True)
+    os.makedirs(temp_thumbnails_folder, exist_ok=True)
+    try:
+        render_charts(batch_data, entry_data, temp_folder, titles=titles, dpi=app.config['GRAPH_DPI'],
+                      thumbnails_folder=temp_thumbnails_folder, thumbnail_dpi=app.config['GRAPH_THUMBNAIL_DPI'])
+
+        current_versions = read_versions(graphs_folder)
+        for title in titles:
+            filename = chart_filename(title)
+            os.replace(os.path.join(temp_thumbnails_folder, filename), os.path.join(thumbnails_folder, filename))
+            os.replace(os.path.join(temp_folder, filename), os.path.join(graphs_folder, filename))
+            current_versions[filename] = versions[filename]
+            job.entry_finished(filename)
+
+        with open(os.path.join(graphs_folder, VERSIONS_FILENAME), 'w') as f:
+            json.dump(current_versions, f)
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+# Get the graphs of a batch to display, queueing a background render of any graph whose data has changed
+# Returns the existing (last good) graphs and whether a render is pending
+def get_batch_graphs(batch):
+    graphs_folder = get_graphs_folder(batch)
+    os.makedirs(graphs_folder, exist_ok=True)
+    batch_data, entry_data = load_graph_data(batch)
+    rendered_versions = read_versions(graphs_folder)
+
+    graphs = []
+    stale_versions = {}
+    for spec in CHART_SPECS:
+        filename = chart_filename(spec['title'])
+        path = os.path.join(graphs_folder, filename)
+        thumbnail_path = os.path.join(graphs_folder, THUMBNAILS_FOLDER, filename)
+        version = graph_version(spec, batch_data, entry_data)
+        if rendered_versions.get(filename) != version or not os.path.exists(path) or not os.path.exists(thumbnail_path):
+            stale_versions[filename] = version
+        if os.path.exists(path):
+            graphs.append({
+                'title': spec['title'],
+                'path': os.path.relpath(path, app.static_folder),
+                'thumbnail_path': os.path.relpath(thumbnail_path if os.path.exists(thumbnail_path) else path, app.static_folder),
+                'version': rendered_versions.get(filename, '')
+            })
+
+    if stale_versions and not entry_data.empty:
+        job_queue.submit('graphs', batch.id, render_graphs, batch.id, batch_data, entry_data, graphs_folder, stale_versions)
+    return graphs, bool(stale_versions)
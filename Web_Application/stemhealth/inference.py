@@ -0,0 +1,182 @@
+import hashlib
+import math
+import os
+import threading
+import cv2
+import numpy as np
+import torch
+import ultralytics
+from ultralytics import YOLO
+from torch.serialization import add_safe_globals
+from stemhealth import app
+from stemhealth.util import file_hash
+
+# Allowlist YOLO SegmentationModel so torch.load() can unpickle it
+add_safe_globals([ultralytics.nn.tasks.SegmentationModel])
+add_safe_globals([torch.nn.modules.container.Sequential])
+
+# Limit the threads used by a single inference if configured
+if app.config['TORCH_THREADS']:
+    torch.set_num_threads(app.config['TORCH_THREADS'])
+
+# Size of the blank frame used to warm up a freshly loaded model
+WARMUP_IMAGE_SIZE = 640
+
+# Modification time of model weights: a file (PyTorch, ONNX) or an exported model directory (OpenVINO)
+def weights_mtime(path):
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    return max([os.path.getmtime(path)] + [os.path.getmtime(os.path.join(root, name))
+                                           for root, _, names in os.walk(path) for name in names])
+
+# Content hash of model weights, covering every file of an exported model directory
+def weights_hash(path):
+    if not os.path.isdir(path):
+        return file_hash(path)
+    sha = hashlib.sha256()
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            file_path = os.path.join(root, name)
+            sha.update(os.path.relpath(file_path, path).encode())
+            sha.update(bytes.fromhex(file_hash(file_path)))
+    return sha.hexdigest()
+
+# A loaded model together with the file state it was loaded from
+class LoadedModel:
+    def __init__(self, model, path, mtime, sha256):
+        self.model = model
+        self.path = path
+        self.mtime = mtime
+        self.sha256 = sha256
+        # ultralytics keeps the state of a prediction (source, batch, results) on the model, so only one prediction
+        # runs on it at a time
+        self.lock = threading.Lock()
+
+    # Predict images with the model (see predict_images), holding its lock until the whole stream is consumed
+    def predict(self, paths, conf, iou, roi=None):
+        with self.lock:
+            yield from predict_images(self.model, paths, conf, iou, roi)
+
+    # Short identifier of the weights, used to tag measurements
+    @property
+    def version(self):
+        return self.sha256[:12]
+
+    def __repr__(self):
+        return f"LoadedModel('{self.path}', '{self.version}')"
+
+# Process-wide registry that keeps each weights file loaded once per worker process
+class ModelRegistry:
+    def __init__(self, warmup=True):
+        self.warmup = warmup
+        self._models = {}
+        self._lock = threading.Lock()
+
+    # Load the model, warm it up with a dummy inference and record the file state
+    # Exported models (ONNX, OpenVINO) are run by ultralytics with their own runtime, reading the task from their metadata
+    def _load(self, path, mtime, sha256):
+        model = YOLO(path)
+        if self.warmup:
+            dummy = np.zeros((WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3), dtype=np.uint8)
+            model.predict(dummy, verbose=False)
+        return LoadedModel(model, path, mtime, sha256)
+
+    # Return the loaded model for a weights file, reloading it only if the file has changed
+    def get(self, path):
+        path = os.path.abspath(path)
+        mtime = weights_mtime(path)
+        with self._lock:
+            loaded = self._models.get(path)
+            if loaded is not None and loaded.mtime == mtime:
+                return loaded
+
+            # The mtime changed (or first use), only reload if the content changed as well
+            sha256 = weights_hash(path)
+            if loaded is not None and loaded.sha256 == sha256:
+                loaded.mtime = mtime
+                return loaded
+
+            loaded = self._load(path, mtime, sha256)
+            self._models[path] = loaded
+            return loaded
+
+registry = ModelRegistry()
+
+# Resolve a model version name (as configured in MODEL_VERSIONS) to its weights path
+def get_model_path(model_version=None):
+    model_versions = app.config['MODEL_VERSIONS']
+    if model_version is None:
+        model_version = app.config['DEFAULT_MODEL_VERSION']
+    if model_version not in model_versions:
+        raise KeyError(f"Unknown model version: {model_version}")
+    return os.path.join(app.static_folder, model_versions[model_version])
+
+# Get the resident model for a model version, loading it on first use
+def get_model(model_version=None):
+    return registry.get(get_model_path(model_version))
+
+# Convert a YOLO result to plain detections: the image path and the boxes, confidences and class IDs as arrays
+# The boxes of a result predicted on a crop are moved by the (x, y) offset of the crop, back to full frame coordinates
+def result_to_detections(result, path=None, offset=None):
+    boxes = result.boxes
+    xyxy = boxes.xyxy.cpu().numpy()
+    if offset is not None:
+        xyxy = xyxy + np.array([offset[0], offset[1], offset[0], offset[1]], dtype=xyxy.dtype)
+    return {
+        'path': path or result.path,
+        'xyxy': xyxy,
+        'conf': boxes.conf.cpu().numpy(),
+        'cls': boxes.cls.cpu().numpy().astype(int)
+    }
+
+# Image size the model was trained with, which it predicts at by default
+def default_image_size(model):
+    image_size = model.overrides.get('imgsz') or 640
+    return max(image_size) if isinstance(image_size, (list, tuple)) else image_size
+
+# Crop the region of interest (x1, y1, x2, y2) out of images
+# Returns the crops and the image size to predict them at: ROI_IMAGE_SIZE if set, otherwise the size that keeps the
+# scale the model sees full frames at, so fewer pixels go through the model
+def load_roi_crops(paths, roi, image_size):
+    x1, y1, x2, y2 = roi
+    crops = []
+    scale = 0
+    for path in paths:
+        image = cv2.imread(path)
+        if image is None:
+            raise FileNotFoundError(f"Could not read the image {path}")
+        crop = image[y1:y2, x1:x2]
+        crops.append(crop)
+        scale = max(scale, max(crop.shape[:2]) / max(image.shape[:2]))
+    if app.config['ROI_IMAGE_SIZE']:
+        return crops, app.config['ROI_IMAGE_SIZE']
+    # Image sizes are multiples of the model stride (32)
+    return crops, max(32, math.ceil(image_size * scale / 32) * 32)
+
+# Predict images with a model, or only their region of interest (x1, y1, x2, y2) if given,
+# yielding the detections of each image in full frame coordinates as they are produced
+def predict_images(model, paths, conf, iou, roi=None):
+    max_det = app.config['MAX_DETECTIONS']
+    if roi is None:
+        for result in model.predict(paths, stream=True, batch=len(paths), iou=iou, conf=conf, max_det=max_det):
+            yield result_to_detections(result)
+        return
+    crops, image_size = load_roi_crops(paths, roi, default_image_size(model))
+    results = model.predict(crops, stream=True, batch=len(crops), iou=iou, conf=conf, imgsz=image_size, max_det=max_det)
+    for path, result in zip(paths, results):
+        yield result_to_detections(result, path, offset=roi[:2])
+
+# Runs the predictions with the resident model of this process
+class LocalPredictor:
+    def __init__(self, model_version=None):
+        self.loaded = get_model(model_version)
+        self.names = self.loaded.model.names
+        self.version = self.loaded.version
+
+    # Predict a list of images (or only their region of interest), yielding the detections of each image as it is produced
+    def predict(self, paths, conf, iou, roi=None):
+        return self.loaded.predict(paths, conf, iou, roi)
+
+    def close(self):
+        pass
@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+import numpy as np
+from stemhealth import app
+
+# Run with "python -m stemhealth.inference_server" and set INFERENCE_SERVER_ADDRESS in the web application,
+# so a single process holds the model and the images of concurrent measurement jobs are batched together
+# Messages are exchanged as JSON, so a client can never make the server unpickle an object
+
+# Address the server listens on when none is given: a Unix socket (a named pipe on Windows)
+DEFAULT_ADDRESS = r'\\.\pipe\stemhealth-inference' if sys.platform == 'win32' else '/tmp/stemhealth-inference.sock'
+# Hosts of the loopback interface, the only ones a "host:port" address may use unless INFERENCE_SERVER_ALLOW_REMOTE is set
+LOOPBACK_HOSTS = ('localhost', '127.0.0.1')
+# Largest request a client may send, in bytes
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+# Parse an address: "host:port" is a TCP address, anything else a Unix socket path
+# TCP addresses must be on the loopback interface unless INFERENCE_SERVER_ALLOW_REMOTE is set
+def parse_address(address):
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit():
+        host = host or 'localhost'
+        if host not in LOOPBACK_HOSTS and not app.config['INFERENCE_SERVER_ALLOW_REMOTE']:
+            raise ValueError(f"The inference server address {address} is not on the loopback interface, "
+                             f"set INFERENCE_SERVER_ALLOW_REMOTE to allow it")
+        return (host, int(port))
+    return address
+
+# Key authenticating the web application to the inference server, from INFERENCE_SERVER_KEY or INFERENCE_SERVER_KEY_FILE
+def get_authkey():
+    key = app.config['INFERENCE_SERVER_KEY']
+    if not key and app.config['INFERENCE_SERVER_KEY_FILE']:
+        with open(app.config['INFERENCE_SERVER_KEY_FILE']) as f:
+            key = f.read().strip()
+    if not key:
+        raise RuntimeError("No inference server key: set STEMHEALTH_INFERENCE_KEY or STEMHEALTH_INFERENCE_KEY_FILE")
+    return key.encode()
+
+def send_message(connection, message):
+    connection.send_bytes(json.dumps(message).encode())
+
+def recv_message(connection, maxlength=None):
+    return json.loads(connection.recv_bytes(maxlength))
+
+# Convert the detections of an image to JSON types, and back to the arrays of inference.result_to_detections
+def encode_detections(detections):
+    return {
+        'path': detections['path'],
+        'xyxy': np.asarray(detections['xyxy']).tolist(),
+        'conf': np.asarray(detections['conf']).tolist(),
+        'cls': np.asarray(detections['cls']).tolist()
+    }
+
+def decode_detections(data):
+    return {
+        'path': data['path'],
+        'xyxy': np.asarray(data['xyxy'], dtype=np.float32).reshape(-1, 4),
+        'conf': np.asarray(data['conf'], dtype=np.float32),
+        'cls': np.asarray(data['cls'], dtype=int)
+    }
+
+# A prediction request of a client, completed image by image by the batching thread
+class PendingRequest:
+    def __init__(self, model_version, paths, conf, iou, roi=None):
+        self.model_version = model_version
+        self.paths = paths
+        self.conf = conf
+        self.iou = iou
+        self.roi = roi
+        self.detections = [None] * len(paths)
+        self.remaining = len(paths)
+        self.error = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        if not paths:
+            self.done.set()
+
+    # Requests can only share a model batch if they use the same model, thresholds and region of interest
+    @property
+    def batch_key(self):
+        return (self.model_version, self.conf, self.iou, self.roi)
+
+    def set_detections(self, index, detections):
+        with self._lock:
+            self.detections[index] = detections
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.done.set()
+
+    def set_error(self, error):
+        with self._lock:
+            self.error = error
+            self.done.set()
+
+# Inference server owning the models, serving prediction requests over multiprocessing connections
+class InferenceServer:
+    def __init__(self, address, authkey, max_batch_size, max_wait):
+        self.address = parse_address(address)
+        self.authkey = authkey
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # Queue of (request, image index) waiting to be batched
+        self.images = queue.Queue()
+        # Images taken from the queue that could not join the current batch
+        self.held = []
+
+    # Take the next batch of images: wait for one, then up to max_wait for more sharing its model, thresholds and region
+    def next_batch(self):
+        batch = [self.held.pop(0) if self.held else self.images.get()]
+        key = batch[0][0].batch_key
+        # Held images with the same key join first, in the order they arrived
+        for item in [item for item in self.held if item[0].batch_key == key][:self.max_batch_size - 1]:
+            self.held.remove(item)
+            batch.append(item)
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.images.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item[0].batch_key == key:
+                batch.append(item)
+            else:
+                self.held.append(item)
+        return batch
+
+    # Predict a batch of images sharing a model, thresholds and region, sending the detections of each to its request
+    def predict_batch(self, batch):
+        from stemhealth import inference
+        request = batch[0][0]
+        loaded = inference.get_model(request.model_version)
+        paths = [pending.paths[index] for pending, index in batch]
+        detections = loaded.predict(paths, request.conf, request.iou, request.roi)
+        for (pending, index), image_detections in zip(batch, detections):
+            pending.set_detections(index, image_detections)
+
+    # Run the batches on the model, one at a time
+    # If a batch fails, its images without detections yet are predicted again one by one, so only the requests of the
+    # images that fail get the error and the other requests sharing the batch are completed
+    def run_batches(self):
+        while True:
+            # Images of requests that already failed are not predicted
+            batch = [item for item in self.next_batch() if item[0].error is None]
+            if not batch:
+                continue
+            try:
+                self.predict_batch(batch)
+            except Exception as e:
+                traceback.print_exc()
+                if len(batch) == 1:
+                    batch[0][0].set_error(f"{type(e).__name__}: {e}")
+                    continue
+                for pending, index in batch:
+                    if pending.error is not None or pending.detections[index] is not None:
+                        continue
+                    try:
+                        self.predict_batch([(pending, index)])
+                    except Exception as e:
+                        traceback.print_exc()
+                        pending.set_error(f"{type(e).__name__}: {e}")
+
+    # Serve the requests of a client connection until it is closed
+    def handle_connection(self, connection):
+        from stemhealth import inference
+        with connection:
+            while True:
+                try:
+                    message = recv_message(connection, MAX_REQUEST_BYTES)
+                except (EOFError, OSError, ValueError):
+                    return
+                try:
+                    loaded = inference.get_model(message['model_version'])
+                    roi = message.get('roi')
+                    pending = PendingRequest(message['model_version'], [str(path) for path in message['paths']],
+                                             message['conf'], message['iou'], tuple(roi) if roi is not None else None)
+                except Exception as e:
+                    send_message(connection, {'error': f"{type(e).__name__}: {e}"})
+                    continue
+
+                for index in range(len(pending.paths)):
+                    self.images.put((pending, index))
+                pending.done.wait()
+                if pending.error is not None:
+                    send_message(connection, {'error': pending.error})
+                else:
+                    send_message(connection, {'names': loaded.model.names, 'version': loaded.version,
+                                              'detections': [encode_detections(detections) for detections in pending.detections]})
+
+    def serve_forever(self):
+        threading.Thread(target=self.run_batches, name='inference-batches', daemon=True).start()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            # Only the user running the server can connect to its Unix socket
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.chmod(self.address, 0o600)
+            print(f"Inference server listening on {listener.address}")
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:
+                    print(f"Rejected a connection: {e}")
+                    continue
+                threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+
+# Client of the inference server, with the same interface as inference.LocalPredictor
+class InferenceClient:
+    def __init__(self, address, authkey, model_version=None):
+        self.connection = Client(parse_address(address), authkey=authkey)
+        self.model_version = model_version or app.config['DEFAULT_MODEL_VERSION']
+        # An empty request returns the class names and weights version of the model
+        self.names = None
+        self.version = None
+        try:
+            self.predict([], conf=None, iou=None)
+        except Exception:
+            self.close()
+            raise
+
+    # Predict a list of images (or only their region of interest), returning the detections of each image
+    def predict(self, paths, conf, iou, roi=None):
+        send_message(self.connection, {'model_version': self.model_version, 'paths': list(paths), 'conf': conf,
+                                       'iou': iou, 'roi': [int(value) for value in roi] if roi is not None else None})
+        reply = recv_message(self.connection)
+        if 'error' in reply:
+            raise RuntimeError(f"Inference server error: {reply['error']}")
+        # JSON object keys are strings
+        self.names = {int(k): v for k, v in reply['names'].items()}
+        self.version = reply['version']
+        return [decode_detections(detections) for detections in reply['detections']]
+
+    def close(self):
+        self.connection.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the inference server holding the YOLO models.")
+    parser.add_argument('--address', default=app.config['INFERENCE_SERVER_ADDRESS'] or DEFAULT_ADDRESS,
+                        help='"host:port" on the loopback interface or a Unix socket path')
+    parser.add_argument('--threads', type=int, default=app.config['TORCH_THREADS'], help="torch intra-op threads")
+    parser.add_argument('--max-batch-size', type=int, default=app.config['INFERENCE_SERVER_BATCH_SIZE'])
+    parser.add_argument('--max-wait-ms', type=float, default=app.config['INFERENCE_SERVER_MAX_WAIT_MS'])
+    args = parser.parse_args()
+    try:
+        authkey = get_authkey()
+        parse_address(args.address)
+    except (OSError, RuntimeError, ValueError) as e:
+        parser.error(str(e))
+
+    # Set the thread count before torch is imported, then load the default model so the first request is not delayed
+    app.config['TORCH_THREADS'] = args.threads
+    from stemhealth import inference
+    inference.get_model()
+
+    server = InferenceServer(args.address, authkey, args.max_batch_size, args.max_wait_ms / 1000)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import os
+from sqlalchemy import insert, select
+from werkzeug.utils import secure_filename
+from stemhealth import app, db
+from stemhealth.models import Entry
+from stemhealth.preprocessing import preprocess_uploads
+from stemhealth.util import build_entry_rows
+
+# Define constants
+ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+ALLOWED_JSON_EXTENSIONS = {'json'}
+
+# Create the data directories of a batch
+# Returns the batch, original images and predicted images directories
+def make_batch_dirs(batch_name):
+    batch_dir = os.path.join(app.config['UPLOAD_FOLDER'], batch_name.replace(' ', '_'))
+    original_images_dir = os.path.join(batch_dir, 'original_images')
+    predicted_images_dir = os.path.join(batch_dir, 'predicted_images')
+    os.makedirs(original_images_dir, exist_ok=True)
+    os.makedirs(predicted_images_dir, exist_ok=True)
+    return batch_dir, original_images_dir, predicted_images_dir
+
+# Sharpen and store the images (uploaded files) of a batch and insert their entries, in the session's transaction
+# Images already in the batch are skipped, so the same frames can be sent again safely
+# Returns the number of new entries, the (filename, error) failures, the images without environmental data
+# and the skipped images
+def add_entries(batch, image_files, env_index):
+    _, original_images_dir, predicted_images_dir = make_batch_dirs(batch.name)
+
+    # Compare paths with forward slashes, as batches created on Windows store backslashes
+    existing = {path.replace('\\', '/') for path in db.session.execute(
+        select(Entry.original_image_filepath).where(Entry.batch_id == batch.id)
+    ).scalars()}
+    new_files = []
+    duplicates = []
+    for file in image_files:
+        if not file or not file.filename:
+            continue
+        filename = secure_filename(file.filename)
+        if os.path.relpath(os.path.join(original_images_dir, filename), app.static_folder).replace('\\', '/') in existing:
+            duplicates.append(filename)
+        else:
+            new_files.append(file)
+
+    # Sharpen and save the images in parallel
+    saved_images, failed_images = preprocess_uploads(new_files, original_images_dir, predicted_images_dir)
+
+    # Insert the entries of all the images with environmental data at once
+    entry_rows, missing_env_data = build_entry_rows(saved_images, env_index, batch.id)
+    if entry_rows:
+        db.session.execute(insert(Entry), entry_rows)
+    return len(entry_rows), failed_images, missing_env_data, duplicates
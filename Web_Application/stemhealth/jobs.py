@@ -0,0 +1,235 @@
+import json
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from stemhealth import app, db
+from stemhealth.models import JobRecord
+
+# Job states
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+# A background job with per-entry progress reporting
+# A job run by a JobQueue reports its changes to it (on_change), which stores them in the job's record
+class Job:
+    def __init__(self, kind, batch_id, params=None, on_change=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.batch_id = batch_id
+        # Parameters identifying what the job does, e.g. the model and thresholds of a measurement
+        self.params = params
+        self.status = PENDING
+        self.total = 0
+        self.processed = 0
+        self.current_entry_id = None
+        self.errors = []
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.on_change = on_change
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Job('{self.id}', '{self.kind}', '{self.status}')"
+
+    @property
+    def done(self):
+        return self.status in (COMPLETED, FAILED)
+
+    def _changed(self, commit=False):
+        if self.on_change is not None:
+            self.on_change(self, commit)
+
+    # Methods used by the worker to report progress
+    def start(self, total):
+        with self._lock:
+            self.status = RUNNING
+            self.total = total
+            self.started_at = time.time()
+        self._changed(commit=True)
+
+    def entry_started(self, entry_id):
+        with self._lock:
+            self.current_entry_id = entry_id
+
+    def entry_finished(self, entry_id, error=None):
+        with self._lock:
+            self.processed += 1
+            if error is not None:
+                self.errors.append({'entry_id': entry_id, 'error': str(error)})
+        self._changed()
+
+    def finish(self, error=None):
+        with self._lock:
+            self.status = FAILED if error is not None else COMPLETED
+            self.error = str(error) if error is not None else None
+            self.current_entry_id = None
+            self.finished_at = time.time()
+        self._changed(commit=True)
+
+    # Estimated seconds remaining, based on the average time per processed entry so far
+    def eta(self):
+        if self.status != RUNNING or not self.processed:
+            return None
+        elapsed = time.time() - self.started_at
+        return round(elapsed / self.processed * (self.total - self.processed), 1)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'kind': self.kind,
+                'batch_id': self.batch_id,
+                'params': self.params,
+                'status': self.status,
+                'total': self.total,
+                'processed': self.processed,
+                'progress': round(self.processed / self.total, 3) if self.total else 0.0,
+                'current_entry_id': self.current_entry_id,
+                'eta_seconds': self.eta(),
+                'errors': list(self.errors),
+                'error': self.error
+            }
+
+    # Column values of the record of the job
+    def to_record(self):
+        with self._lock:
+            return {
+                'kind': self.kind,
+                'batch_id': self.batch_id,
+                'params': json.dumps(self.params),
+                'status': self.status,
+                'total': self.total,
+                'processed': self.processed,
+                'current_entry_id': self.current_entry_id,
+                'errors': json.dumps(self.errors),
+                'error': self.error,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at
+            }
+
+    # Rebuild a job from its record, e.g. a job run by another process
+    @classmethod
+    def from_record(cls, record):
+        job = cls(record.kind, record.batch_id, json.loads(record.params) if record.params else None)
+        job.id = record.id
+        job.status = record.status
+        job.total = record.total or 0
+        job.processed = record.processed or 0
+        job.current_entry_id = record.current_entry_id
+        job.errors = json.loads(record.errors) if record.errors else []
+        job.error = record.error
+        job.created_at = record.created_at
+        job.started_at = record.started_at
+        job.finished_at = record.finished_at
+        return job
+
+# Raised when a job is submitted while an unfinished job of the same kind runs on the batch with other parameters
+class JobConflict(Exception):
+    def __init__(self, job):
+        super().__init__(f"A {job.kind} job with other parameters is already running on this batch")
+        self.job = job
+
+# Job queue running jobs on a background thread pool of this process (no external broker)
+# The state of the jobs is stored in the database, so any process of the application can report the progress of a job
+# and only one unfinished job of a kind runs on a batch, whichever process it was submitted to
+class JobQueue:
+    def __init__(self, max_workers=2, max_finished_jobs=100):
+        self.max_finished_jobs = max_finished_jobs
+        # Identifies the jobs run by this process
+        self.owner = uuid.uuid4().hex
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stemhealth-job')
+        # Unfinished jobs of this process
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    # Run the job function inside an application context and record its outcome
+    def _run(self, job, func, args, kwargs):
+        try:
+            with app.app_context():
+                try:
+                    func(job, *args, **kwargs)
+                except Exception as e:
+                    traceback.print_exc()
+                    db.session.rollback()
+                    job.finish(error=e)
+                else:
+                    job.finish()
+        finally:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+
+    # Store the state of a job of this process in its record, refreshing the heartbeat of all the unfinished jobs of
+    # this process. Progress goes through the session of the job, so it is committed with the measurements of each
+    # micro-batch and never waits for the session's own write lock; the start and end of the job are committed straight away
+    def _save(self, job, commit=False):
+        table = JobRecord.__table__
+        db.session.execute(update(table).where(table.c.id == job.id).values(**job.to_record()))
+        db.session.execute(update(table).where(table.c.owner == self.owner, table.c.finished_at.is_(None))
+                           .values(heartbeat_at=time.time()))
+        if commit:
+            db.session.commit()
+
+    # Create the record of a job, unless an unfinished job of the same kind runs on the batch
+    # Returns the record of that unfinished job, or None if the job was created
+    def _claim(self, job):
+        table = JobRecord.__table__
+        while True:
+            now = time.time()
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(insert(table).values(id=job.id, owner=self.owner, heartbeat_at=now, **job.to_record()))
+                    # Forget the oldest finished jobs once there are too many of them
+                    newest = (select(table.c.id).where(table.c.finished_at.is_not(None))
+                              .order_by(table.c.finished_at.desc()).limit(self.max_finished_jobs))
+                    connection.execute(delete(table).where(table.c.finished_at.is_not(None), table.c.id.not_in(newest)))
+                return None
+            except IntegrityError:
+                pass
+            # Another unfinished job of the kind runs on the batch (the unique index allows one)
+            with db.engine.begin() as connection:
+                active = connection.execute(select(table).where(table.c.kind == job.kind, table.c.batch_id == job.batch_id,
+                                                                table.c.finished_at.is_(None))).first()
+                if active is not None and active.heartbeat_at >= now - app.config['JOB_HEARTBEAT_TIMEOUT']:
+                    return active
+                if active is not None:
+                    # The process running the job stopped (or was restarted) before finishing it
+                    connection.execute(update(table).where(table.c.id == active.id)
+                                       .values(status=FAILED, error='The process running the job stopped', finished_at=now))
+            # The job finished in the meantime or was abandoned, so try again
+
+    # Submit a job, reusing the unfinished job of the same kind for the batch if there is one with the same params
+    # Raises JobConflict if the unfinished job has other params, so a request is never silently merged into it
+    def submit(self, kind, batch_id, func, *args, params=None, **kwargs):
+        job = Job(kind, batch_id, params, on_change=self._save)
+        with self._lock:
+            active = self._claim(job)
+            if active is not None:
+                active_job = self._jobs.get(active.id) or Job.from_record(active)
+                if active_job.params != params:
+                    raise JobConflict(active_job)
+                return active_job
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    # Get a job by ID, from this process if it runs it (with the progress not committed yet) or from its record
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        table = JobRecord.__table__
+        with db.engine.connect() as connection:
+            record = connection.execute(select(table).where(table.c.id == job_id)).first()
+        return Job.from_record(record) if record is not None else None
+
+job_queue = JobQueue(max_workers=app.config['JOB_WORKERS'])
@@ -1,6 +1,17 @@
+import hashlib
+import io
+import os
+from collections import OrderedDict
 import cv2
 import numpy as np
 
+# Actual height of the reference object in cm
+REFERENCE_HEIGHT_CM = 5
+# Bump when the geometry computation changes so cached geometry is recomputed
+GEOMETRY_VERSION = 1
+# Number of batch geometries kept in memory
+GEOMETRY_CACHE_SIZE = 16
+
 # Methods to get the sponge mask and reference object mask
 def get_sponge_mask(image_path):
     image = cv2.imread(image_path)
@@ -96,31 +107,26 @@ def get_reference_object_mask(image_path):
     return reference_mask, simplified_reference_mask, approx
 
 # Find the most right point of the mask
+# Returns the first background pixel after the first object run at or right of the coordinate
 def extend_line_to_right_boundary(mask, coord):
     y = coord[1]
     x = coord[0]
 
-    # Initialize the end points
-    right_end = None
-    
-    # Variables to track the current and previous states of the mask value
-    previous_value = 0  # Start outside the object
-    inside_boundary = False
+    # Object pixels in the row, from the coordinate to the right edge of the mask
+    row = mask[y, x:] > 0
+    if row.size == 0:
+        return None
+    start = np.argmax(row)
+    if not row[start]:
+        return None
 
-    # Scan to the right to find the right boundary
-    for i in range(x, mask.shape[1]):
-        current_value = mask[y, i]
+    # Background pixels after entering the object
+    outside = ~row[start:]
+    offset = np.argmax(outside)
+    if not outside[offset]:
+        return None
 
-        if current_value > 0:
-            if not inside_boundary:
-                # Entered the object from background
-                inside_boundary = True
-                previous_value = current_value
-        elif inside_boundary:
-            # Exited the object to background
-            right_end = (i, y)
-            break
-    
+    right_end = (int(x + start + offset), y)
     return right_end
 
 # Find the area where the seedling will be considered for measurement
@@ -159,29 +165,29 @@ def is_within_mask(mask, coord):
 def extend_line_to_boundary(mask, coord):
     y = coord[1]
     x = coord[0]
+    if x < 0:
+        return None
 
-    # Initialize the end points
-    left_end = None
-
-    # Extend line to the left
-    for i in range(x, -1, -1):
-        if mask[y, i] > 0:  # Boundary found
-            left_end = (i, y)
-            break
+    # Extend line to the left: the last object pixel in the row at or left of the coordinate
+    boundary = np.flatnonzero(mask[y, :x + 1])
+    if boundary.size == 0:
+        return None
 
+    left_end = (int(boundary[-1]), y)
     return left_end
 
 # Function to find the top edge of the mask at the same x-coordinate
 def find_top_edge(mask, x):
-    for y in range(mask.shape[0]):
-        if mask[y, x] > 0:
-            return (x, y)
-    return None
+    column = mask[:, x] > 0
+    y = np.argmax(column)
+    if not column[y]:
+        return None
+    return (x, int(y))
 
 # Function to calculate the real-world seedling height
 def calculate_seedling_height(left_end, top_edge_point, height):
     # Calculate the scale factor (5 is the actual height of the reference object)
-    scale = 5 / (left_end[1] - top_edge_point[1])
+    scale = REFERENCE_HEIGHT_CM / (left_end[1] - top_edge_point[1])
     measurement = "{:.2f}".format(height * scale)
     return float(measurement)
 
@@ -193,3 +199,149 @@ def process_image(reference_mask, x1, y1, x2, y2):
     top_edge_point = find_top_edge(reference_mask, left_end[0])
     measurement = calculate_seedling_height(left_end, top_edge_point, height)
     return measurement
+
+
+# Per-batch measurement geometry
+# Holds everything that only depends on the reference and sponge masks, so it is computed once per batch
+class MeasurementGeometry:
+    def __init__(self, eligible_area_mask, reference_mask, reference_right_edge, reference_top_edge, row_scale):
+        self.eligible_area_mask = eligible_area_mask
+        self.reference_mask = reference_mask
+        # Rightmost reference pixel of each row (-1 if the row has none)
+        self.reference_right_edge = reference_right_edge
+        # Topmost reference pixel of each column (-1 if the column has none)
+        self.reference_top_edge = reference_top_edge
+        # px -> cm scale of each row, for points right of the reference object (NaN if unavailable)
+        self.row_scale = row_scale
+
+    def __repr__(self):
+        return f"MeasurementGeometry({self.eligible_area_mask.shape})"
+
+    # Build the geometry from the simplified reference and sponge masks
+    @classmethod
+    def build(cls, simplified_reference_mask, simplified_sponge_mask, simplified_reference_mask_points, simplified_sponge_mask_points):
+        eligible_area_mask = find_eligible_seedling_position(simplified_reference_mask, simplified_sponge_mask, simplified_reference_mask_points, simplified_sponge_mask_points)
+
+        # Edge lookup tables of the reference object
+        reference = simplified_reference_mask > 0
+        rows_with_reference = reference.any(axis=1)
+        reference_right_edge = np.where(rows_with_reference, reference.shape[1] - 1 - np.argmax(reference[:, ::-1], axis=1), -1)
+        reference_top_edge = np.where(reference.any(axis=0), np.argmax(reference, axis=0), -1)
+
+        # Scale of each row, measured from the top edge above the rightmost reference pixel
+        row_scale = np.full(reference.shape[0], np.nan)
+        rows = np.flatnonzero(rows_with_reference)
+        reference_heights = rows - reference_top_edge[reference_right_edge[rows]]
+        valid = reference_heights > 0
+        row_scale[rows[valid]] = REFERENCE_HEIGHT_CM / reference_heights[valid]
+
+        return cls(eligible_area_mask, simplified_reference_mask, reference_right_edge, reference_top_edge, row_scale)
+
+    # Region of the frame seedlings are detected in, as (x1, y1, x2, y2): the columns of the eligible area and every row
+    # down to its bottom (seedlings grow upwards from it), widened by margin pixels. None if there is no eligible area
+    def detection_roi(self, margin):
+        x, y, width, height = cv2.boundingRect((self.eligible_area_mask > 0).astype(np.uint8))
+        if width == 0 or height == 0:
+            return None
+        frame_height, frame_width = self.eligible_area_mask.shape[:2]
+        return (max(x - margin, 0), 0, min(x + width + margin, frame_width), min(y + height + margin, frame_height))
+
+    # Calculate the seedling height in cm, using the scale tables when possible
+    def measure(self, x1, y1, x2, y2):
+        if 0 <= y2 < len(self.row_scale) and x2 >= self.reference_right_edge[y2] >= 0 and not np.isnan(self.row_scale[y2]):
+            return float("{:.2f}".format((y2 - y1) * self.row_scale[y2]))
+        return process_image(self.reference_mask, x1, y1, x2, y2)
+
+    # Check the eligibility and calculate the height in cm of all the boxes of an image in one pass
+    # Returns the eligibility flags and the heights (NaN for ineligible boxes)
+    def measure_boxes(self, xyxy):
+        boxes = np.asarray(xyxy, dtype=np.float64).reshape(-1, 4).astype(np.int64)
+        x1, y1, x2, y2 = boxes.T
+        heights = y2 - y1
+        widths = x2 - x1
+
+        # Eligible if the bottom-right corner is within the eligible area and the height is greater than the width
+        mask_height, mask_width = self.eligible_area_mask.shape[:2]
+        inside = (x2 >= 0) & (x2 < mask_width) & (y2 >= 0) & (y2 < mask_height)
+        eligible = np.zeros(len(boxes), dtype=bool)
+        eligible[inside] = self.eligible_area_mask[y2[inside], x2[inside]] > 0
+        eligible &= heights > widths
+
+        # Heights from the scale table for boxes right of the reference object
+        heights_cm = np.full(len(boxes), np.nan)
+        index = np.flatnonzero(eligible)
+        right_edge = self.reference_right_edge[y2[index]]
+        scale = self.row_scale[y2[index]]
+        from_table = (right_edge >= 0) & (x2[index] >= right_edge) & ~np.isnan(scale)
+        heights_cm[index[from_table]] = round_2dp(heights[index[from_table]] * scale[from_table])
+
+        # Other boxes are measured by scanning the reference mask
+        for i in index[~from_table]:
+            heights_cm[i] = process_image(self.reference_mask, int(x1[i]), int(y1[i]), int(x2[i]), int(y2[i]))
+
+        return eligible, heights_cm
+
+    def save(self, path):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer,
+                            eligible_area_mask=self.eligible_area_mask,
+                            reference_mask=self.reference_mask,
+                            reference_right_edge=self.reference_right_edge,
+                            reference_top_edge=self.reference_top_edge,
+                            row_scale=self.row_scale)
+        # Write to a temporary file first so a concurrent reader never sees a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(buffer.getvalue())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['eligible_area_mask'], data['reference_mask'], data['reference_right_edge'],
+                       data['reference_top_edge'], data['row_scale'])
+
+# Round to 2 decimals exactly like "{:.2f}".format, fixing up the values np.round may get wrong near a tie
+def round_2dp(values):
+    values = np.asarray(values, dtype=np.float64)
+    rounded = np.round(values, 2)
+    scaled = values * 100
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for i in np.flatnonzero(near_tie):
+        rounded[i] = float("{:.2f}".format(values[i]))
+    return rounded
+
+_geometry_cache = OrderedDict()
+
+# Method to compute the cache key of the geometry from the sponge image and the reference mask
+def geometry_cache_key(sponge_image_path, simplified_reference_mask, simplified_reference_mask_points):
+    sha = hashlib.sha256(f"v{GEOMETRY_VERSION}".encode())
+    with open(sponge_image_path, 'rb') as f:
+        sha.update(hashlib.sha256(f.read()).digest())
+    sha.update(np.ascontiguousarray(simplified_reference_mask).tobytes())
+    sha.update(np.ascontiguousarray(simplified_reference_mask_points).tobytes())
+    return sha.hexdigest()
+
+# Get the measurement geometry of a batch, from the memory or disk cache if it was computed before
+# Returns the geometry and its cache key
+def get_measurement_geometry(sponge_image_path, simplified_reference_mask, simplified_reference_mask_points, cache_dir=None):
+    key = geometry_cache_key(sponge_image_path, simplified_reference_mask, simplified_reference_mask_points)
+    geometry = _geometry_cache.get(key)
+    if geometry is not None:
+        _geometry_cache.move_to_end(key)
+        return geometry, key
+
+    cache_path = os.path.join(cache_dir, f"geometry_{key[:16]}.npz") if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        geometry = MeasurementGeometry.load(cache_path)
+    else:
+        _, simplified_sponge_mask, simplified_sponge_mask_points = get_sponge_mask(sponge_image_path)
+        geometry = MeasurementGeometry.build(simplified_reference_mask, simplified_sponge_mask, simplified_reference_mask_points, simplified_sponge_mask_points)
+        if cache_path:
+            os.makedirs(cache_dir, exist_ok=True)
+            geometry.save(cache_path)
+
+    _geometry_cache[key] = geometry
+    if len(_geometry_cache) > GEOMETRY_CACHE_SIZE:
+        _geometry_cache.popitem(last=False)
+    return geometry, key
@@ -1,9 +1,12 @@
+from sqlalchemy.orm import validates
 from stemhealth import db
 
 # Batch model: Represents a batch of seedlings
 class Batch(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
+    # Normalised (stripped, lowercased) name used for case-insensitive lookups and uniqueness
+    name_key = db.Column(db.String(100), unique=True, index=True)
     species = db.Column(db.String(100), nullable=False)
     optimum_duration = db.Column(db.String(50), default=None)
     optimum_entry_id = db.Column(db.Integer, default=None)
@@ -12,6 +15,16 @@ class Batch(db.Model):
     def __repr__(self):
         return f"Batch('{self.name}', '{self.species}')"
 
+    @staticmethod
+    def normalize_name(name):
+        return name.strip().lower()
+
+    # Keep the name key in sync with the name
+    @validates('name')
+    def validate_name(self, key, name):
+        self.name_key = Batch.normalize_name(name)
+        return name
+
 # Entry model: Represents a single entry of a batch
 class Entry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -24,9 +37,43 @@ class Entry(db.Model):
     average_height = db.Column(db.Float, server_default="0.0")
     individual_heights = db.relationship('IndividualHeight', backref='entry', lazy=True)
     batch_id = db.Column(db.Integer, db.ForeignKey('batch.id'), nullable=False)
+    # Inputs of the last measurement (image content hash, model weights version, measurement parameters version),
+    # so an entry is only measured again when one of them changes
+    image_hash = db.Column(db.String(64), default=None)
+    model_version = db.Column(db.String(64), default=None)
+    params_version = db.Column(db.String(64), default=None)
+    # Size and modification time (in nanoseconds) of the image when its hash was computed, so unchanged images are
+    # not hashed again
+    image_size = db.Column(db.Integer, default=None)
+    image_mtime_ns = db.Column(db.Integer, default=None)
+    # Whether the last measurement applied its thresholds to detections the model predicted with looser ones
+    # (RAW_DETECTION_CACHE, or measuring from the cache): the boxes then only approximate a prediction with them
+    refiltered = db.Column(db.Boolean, default=None)
+    # When the entry was last measured, part of the version of the cached batch statistics
+    measured_at = db.Column(db.DateTime, default=None)
+    # Compact detections (see detections.py), set instead of IndividualHeight rows when COMPACT_DETECTIONS is on
+    # The blob is only loaded when accessed
+    detections = db.deferred(db.Column(db.LargeBinary, default=None))
+    detection_labels = db.Column(db.Text, default=None)
+    # The entries of a batch are looked up and ordered by timestamp
+    __table_args__ = (db.Index('ix_entry_batch_id_timestamp', 'batch_id', 'timestamp'),)
 
     def __repr__(self):
         return f"Entry('{self.original_image_filepath}', '{self.timestamp}', '{self.temperature}', '{self.humidity}')"
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'original_image_filepath': self.original_image_filepath,
+            'timestamp': self.timestamp.isoformat(),
+            'temperature': self.temperature,
+            'humidity': self.humidity,
+            'predicted_image_filepath': self.predicted_image_filepath,
+            'predicted_seedlings': self.predicted_seedlings,
+            'average_height': self.average_height,
+            'refiltered': bool(self.refiltered),
+            'batch_id': self.batch_id
+        }
     
 # IndividualHeight model: Represents the height of a single seedling and its associated YOLO prediction data
 class IndividualHeight(db.Model):
@@ -38,7 +85,7 @@ class IndividualHeight(db.Model):
     y1 = db.Column(db.Integer, nullable=False)
     x2 = db.Column(db.Integer, nullable=False)
     y2 = db.Column(db.Integer, nullable=False)
-    entry_id = db.Column(db.Integer, db.ForeignKey('entry.id'), nullable=False)
+    entry_id = db.Column(db.Integer, db.ForeignKey('entry.id'), nullable=False, index=True)
 
     def __repr__(self):
         return f"IndividualHeight('{self.height}', '{self.yolo_prediction})"
@@ -55,3 +102,30 @@ class IndividualHeight(db.Model):
             'y2': self.y2,
             'entry_id': self.entry_id
         }
+
+# JobRecord model: Represents the state of a background job (see jobs.py), shared by the processes of the application
+class JobRecord(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    batch_id = db.Column(db.Integer, nullable=False)
+    # Parameters of the job and errors of its entries, as JSON
+    params = db.Column(db.Text, default=None)
+    status = db.Column(db.String(20), nullable=False)
+    total = db.Column(db.Integer, default=0)
+    processed = db.Column(db.Integer, default=0)
+    current_entry_id = db.Column(db.Integer, default=None)
+    errors = db.Column(db.Text, default=None)
+    error = db.Column(db.Text, default=None)
+    # Job queue of the process running the job
+    owner = db.Column(db.String(32), nullable=False)
+    # Times as seconds since the epoch; the heartbeat is refreshed while the owner runs its jobs
+    created_at = db.Column(db.Float, nullable=False)
+    started_at = db.Column(db.Float, default=None)
+    finished_at = db.Column(db.Float, default=None)
+    heartbeat_at = db.Column(db.Float, nullable=False)
+    # Only one unfinished job of a kind per batch, across all the processes
+    __table_args__ = (db.Index('ix_job_record_active', 'kind', 'batch_id', unique=True,
+                               sqlite_where=db.text('finished_at IS NULL')),)
+
+    def __repr__(self):
+        return f"JobRecord('{self.id}', '{self.kind}', '{self.status}')"
@@ -0,0 +1,306 @@
+import datetime as dt
+import hashlib
+import os
+import threading
+import cv2
+import numpy as np
+from sqlalchemy import delete, insert
+from stemhealth import app, db
+from stemhealth.models import Batch, IndividualHeight
+from stemhealth import measurement
+from stemhealth.detections import RawDetectionCache, filter_detections, pack_detections
+from stemhealth.util import calculate_optimum_duration, file_hash
+from stemhealth.queries import invalidate_batch_stats
+
+# Define constants
+REFERENCE_OBJECT = "reference_object.png"
+# Thresholds the seedlings are measured with (with RAW_DETECTION_CACHE, the model predicts with the looser
+# RAW_DETECTION_CONF and RAW_DETECTION_IOU instead, so its cached detections can be measured again with other thresholds)
+PREDICT_CONF = 0.5
+PREDICT_IOU = 0.65
+# Bump when the way seedlings are measured changes, so every entry is measured again
+MEASUREMENT_VERSION = 1
+
+# Reference object masks, obtained on first use so importing the application does not pay for them
+_reference_masks = None
+_reference_masks_lock = threading.Lock()
+
+# Get the (reference mask, simplified reference mask, simplified reference mask approximation) of the reference object
+def get_reference_masks():
+    global _reference_masks
+    with _reference_masks_lock:
+        if _reference_masks is None:
+            _reference_masks = measurement.get_reference_object_mask(os.path.join(app.static_folder, REFERENCE_OBJECT))
+        return _reference_masks
+
+# Normalised absolute path used to match YOLO results to entries
+def image_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+# Get the predictor for a model version: a client of the inference server if one is configured,
+# otherwise the model resident in this process (only then are torch and ultralytics imported)
+def get_predictor(model_version=None):
+    if app.config['INFERENCE_SERVER_ADDRESS']:
+        from stemhealth.inference_server import InferenceClient, get_authkey
+        return InferenceClient(app.config['INFERENCE_SERVER_ADDRESS'], get_authkey(), model_version)
+    from stemhealth import inference
+    return inference.LocalPredictor(model_version)
+
+# Calculate the average height of the seedlings of an entry, 0 if no seedlings were detected
+def average_height(measurements):
+    if measurements:
+        return float("{:.2f}".format(sum(measurements) / len(measurements)))
+    return 0.0
+
+# Measure the seedlings of a single entry from its detections (image path, boxes, confidences and class IDs)
+# The entry is only updated once the measurement has succeeded
+# Returns the individual height rows of the entry, to be inserted in bulk
+def measure_entry(entry, detections, names, geometry, predicted_images_path):
+    measurements = []
+    individual_heights = []
+
+    # Get the filename of the predicted image
+    predicted_image_filename = os.path.basename(detections['path'])
+    predicted_image_rel_path = os.path.relpath(os.path.join(predicted_images_path, predicted_image_filename), app.static_folder)
+
+    # Check if any seedlings were detected
+    if len(detections['conf']):
+        original_image = cv2.imread(os.path.join(app.static_folder, entry.original_image_filepath))
+
+        # Check the eligibility and calculate the heights of all the boxes at once
+        xyxy = detections['xyxy']
+        confidences = detections['conf']
+        class_ids = detections['cls']
+        eligible, heights = geometry.measure_boxes(xyxy)
+
+        for i in np.flatnonzero(eligible):
+            x1, y1, x2, y2 = map(int, xyxy[i])
+            predicted_height = float(heights[i])
+            cv2.rectangle(original_image, (x1, y1), (x2, y2), (248, 4, 8), 1)
+            measurements.append(predicted_height)
+            # Save the individual height along with YOLO prediction details
+            individual_heights.append({
+                'height': predicted_height,
+                'label': names[class_ids[i]],
+                'confidence': float(confidences[i]),
+                'x1': x1,
+                'y1': y1,
+                'x2': x2,
+                'y2': y2,
+                'entry_id': entry.id
+            })
+        cv2.imwrite(os.path.join(predicted_images_path, predicted_image_filename), original_image)
+
+    entry.predicted_image_filepath = predicted_image_rel_path
+    entry.predicted_seedlings = len(measurements)
+    entry.average_height = average_height(measurements)
+    return individual_heights
+
+# Get the cached raw detections of an image, or an error if it was never predicted with the model version
+def load_cached_detections(cache, path, image_hash, model_version):
+    detections = cache.load(image_hash, model_version)
+    if detections is None:
+        return {'path': path, 'error': 'No cached detections for this image, it must be measured with the model with RAW_DETECTION_CACHE set first'}
+    detections['path'] = path
+    return detections
+
+# Thresholds the model predicts with to measure with the (conf, iou) thresholds: the looser raw thresholds if
+# RAW_DETECTION_CACHE is set, so its detections can be cached, otherwise (conf, iou) themselves
+def get_raw_thresholds(conf, iou):
+    if app.config['RAW_DETECTION_CACHE']:
+        return min(conf, app.config['RAW_DETECTION_CONF']), max(iou, app.config['RAW_DETECTION_IOU'])
+    return conf, iou
+
+# Hash the image of an entry, unless its size and modification time are those recorded with its last hash
+# Returns the hash and the (size, modification time) of the image
+def get_image_hash(entry, image_path):
+    stat = os.stat(image_path)
+    image_stat = (stat.st_size, stat.st_mtime_ns)
+    if entry.image_hash and (entry.image_size, entry.image_mtime_ns) == image_stat:
+        return entry.image_hash, image_stat
+    return file_hash(image_path), image_stat
+
+# Predict and measure a micro-batch of images, committing the measurements of its entries
+# inputs maps each entry ID to the (image hash, model version, parameters version) it is measured with, and
+# image_stats to the (size, modification time) of its image when it was hashed
+# The model predicts with the (conf, iou) thresholds, unless RAW_DETECTION_CACHE is set: then it predicts with the raw
+# thresholds and its detections are cached before the (conf, iou) thresholds are applied
+# Without a predictor the entries are measured again from the cached detections instead
+# Applying the thresholds afterwards (filter_detections) only approximates a prediction with them, as the model
+# suppresses overlapping boxes before its confidence threshold; such entries are marked as refiltered
+def measure_chunk(job, chunk, entries_by_image, inputs, image_stats, predictor, geometry, predicted_images_path, thresholds, cache,
+                  roi=None):
+    conf, iou = thresholds
+    raw_conf, raw_iou = get_raw_thresholds(conf, iou)
+    if predictor is None:
+        results = (load_cached_detections(cache, key, *inputs[entries_by_image[key].id][:2]) for key in chunk)
+    else:
+        results = predictor.predict(chunk, conf=raw_conf, iou=raw_iou, roi=roi)
+
+    pending = set(chunk)
+    measured_entry_ids = []
+    individual_heights = []
+    # Process the predictions and collect the individual heights
+    for detections in results:
+        key = image_key(detections['path'])
+        entry = entries_by_image[key]
+        pending.discard(key)
+        job.entry_started(entry.id)
+        if 'error' in detections:
+            job.entry_finished(entry.id, error=detections['error'])
+            continue
+        try:
+            if predictor is None:
+                names, raw_thresholds = detections['names'], detections['thresholds']
+            else:
+                names, raw_thresholds = predictor.names, (raw_conf, raw_iou)
+                if app.config['RAW_DETECTION_CACHE']:
+                    image_hash, model_version, _ = inputs[entry.id]
+                    cache.save(image_hash, model_version, detections, names, raw_conf, raw_iou)
+            detections = filter_detections(detections, conf, iou, *raw_thresholds)
+            entry_heights = measure_entry(entry, detections, names, geometry, predicted_images_path)
+        except Exception as e:
+            job.entry_finished(entry.id, error=e)
+        else:
+            # Store the heights packed on the entry, or as IndividualHeight rows
+            if app.config['COMPACT_DETECTIONS']:
+                entry.detections, entry.detection_labels = pack_detections(entry_heights)
+            else:
+                entry.detections, entry.detection_labels = None, None
+                individual_heights.extend(entry_heights)
+            measured_entry_ids.append(entry.id)
+            entry.image_hash, entry.model_version, entry.params_version = inputs[entry.id]
+            entry.image_size, entry.image_mtime_ns = image_stats[entry.id]
+            entry.refiltered = tuple(raw_thresholds) != (conf, iou)
+            entry.measured_at = dt.datetime.now()
+            job.entry_finished(entry.id)
+
+    # Report the entries the model produced no result for
+    for key in pending:
+        job.entry_finished(entries_by_image[key].id, error='No prediction was produced for this image')
+
+    # Replace the heights of any previous measurement of the measured entries with one bulk delete and insert,
+    # committed together with the entry updates so the session only holds one micro-batch at a time
+    if measured_entry_ids:
+        db.session.execute(delete(IndividualHeight).where(IndividualHeight.entry_id.in_(measured_entry_ids)))
+    if individual_heights:
+        db.session.execute(insert(IndividualHeight), individual_heights)
+    db.session.commit()
+
+# Version of the measurement parameters: the prediction thresholds, the measurement geometry of the batch and,
+# when the thresholds are applied to detections predicted with looser ones, where those come from ('cache' or the
+# raw thresholds), so switching RAW_DETECTION_CACHE or its thresholds measures the entries again
+def measurement_params_version(geometry_key, conf=PREDICT_CONF, iou=PREDICT_IOU, raw_thresholds=None):
+    params = f"{MEASUREMENT_VERSION}:{conf}:{iou}:{geometry_key}"
+    if raw_thresholds is not None:
+        params += f":raw:{raw_thresholds}"
+    return hashlib.sha256(params.encode()).hexdigest()[:16]
+
+# Get the data folder of a batch, its measurement geometry (eligible area and scale tables, from the sponge of the
+# first image) and the cache key of the geometry
+def get_batch_geometry(batch):
+    batch_path = os.path.join(app.static_folder, 'seedling_data', batch.name.replace(' ', '_'))
+    sponge_image_path = os.path.join(app.static_folder, batch.entries[0].original_image_filepath)
+    _, simplified_reference_mask, simplified_reference_mask_approx = get_reference_masks()
+    geometry, geometry_key = measurement.get_measurement_geometry(sponge_image_path, simplified_reference_mask,
+                                                                  simplified_reference_mask_approx,
+                                                                  cache_dir=os.path.join(batch_path, 'measurement_cache'))
+    return batch_path, geometry, geometry_key
+
+# Region of the frames the model predicts (only the eligible area and the rows above it) if ROI_INFERENCE is set,
+# with the version tag of the detections predicted on it; (None, model version) to predict full frames
+def get_inference_roi(geometry, model_version):
+    roi = geometry.detection_roi(app.config['ROI_MARGIN']) if app.config['ROI_INFERENCE'] else None
+    if roi is None:
+        return None, model_version
+    # Detections depend on the region and size it is predicted at, so they are cached and measured separately
+    roi_key = hashlib.sha256(f"{roi}:{app.config['ROI_IMAGE_SIZE']}".encode()).hexdigest()[:8]
+    return roi, f"{model_version}-roi-{roi_key}"
+
+# Cache of the raw detections of the images of a batch
+def get_detection_cache(batch_path):
+    return RawDetectionCache(os.path.join(batch_path, 'measurement_cache', 'detections'))
+
+# Job function performing the predictions and measurements on a batch
+# Only the entries whose image, model or measurement parameters changed since they were last measured are processed,
+# unless force is set. With from_cache, the entries are measured from the raw detections cached when they were last
+# predicted (keeping their model version) rather than by the model, e.g. to apply other conf and iou thresholds
+def measure_batch(job, batch_id, model_version=None, force=False, from_cache=False, conf=PREDICT_CONF, iou=PREDICT_IOU):
+    batch = db.session.get(Batch, batch_id)
+    entries = batch.entries
+
+    batch_path, geometry, geometry_key = get_batch_geometry(batch)
+    raw_thresholds = 'cache' if from_cache else get_raw_thresholds(conf, iou)
+    params_version = measurement_params_version(geometry_key, conf, iou,
+                                                raw_thresholds if raw_thresholds != (conf, iou) else None)
+    predicted_images_path = os.path.join(batch_path, 'predicted_images')
+    cache = get_detection_cache(batch_path)
+
+    # Get the predictor (the inference server or the model resident in this process), unless measuring from the cache
+    predictor = None if from_cache else get_predictor(model_version)
+    try:
+        # Tag the detections with the model version, and the region of the frames predicted if ROI_INFERENCE is set
+        roi, predictor_version = (None, None) if from_cache else get_inference_roi(geometry, predictor.version)
+        # Select the entries whose measurement inputs changed
+        inputs = {}
+        image_stats = {}
+        entries_by_image = {}
+        for entry in entries:
+            image_path = os.path.join(app.static_folder, entry.original_image_filepath)
+            version = entry.model_version if from_cache else predictor_version
+            image_hash, image_stats[entry.id] = get_image_hash(entry, image_path)
+            # An image touched without changing is not hashed again next time
+            if image_hash == entry.image_hash:
+                entry.image_size, entry.image_mtime_ns = image_stats[entry.id]
+            inputs[entry.id] = (image_hash, version, params_version)
+            if force or (entry.image_hash, entry.model_version, entry.params_version) != inputs[entry.id]:
+                # Map the image of each entry to the entry, so results are matched by path rather than position
+                entries_by_image[image_key(image_path)] = entry
+        image_paths = list(entries_by_image)
+        batch_size = app.config['INFERENCE_BATCH_SIZE']
+        job.start(total=len(image_paths))
+
+        # Perform predictions one micro-batch at a time, persisting each result as soon as it is produced
+        for start in range(0, len(image_paths), batch_size):
+            chunk = image_paths[start:start + batch_size]
+            measure_chunk(job, chunk, entries_by_image, inputs, image_stats, predictor, geometry, predicted_images_path, (conf, iou),
+                          cache, roi)
+    finally:
+        if predictor is not None:
+            predictor.close()
+
+    # Calculate and update the optimum duration for the batch
+    calculate_optimum_duration(batch)
+    db.session.commit()
+    invalidate_batch_stats(batch_id)
+
+# Measure a batch from its cached raw detections with each of the given (conf, iou) thresholds, without storing
+# anything, to compare thresholds over historical batches
+# Returns, per thresholds, the number of entries with cached detections, the number of measured seedlings and the
+# mean of the entry average heights
+def sweep_batch(batch_id, thresholds):
+    batch = db.session.get(Batch, batch_id)
+    batch_path, geometry, _ = get_batch_geometry(batch)
+    cache = get_detection_cache(batch_path)
+    # Load the detections of each entry once, as it was last measured (image hash and model version)
+    cached = [detections for detections in (cache.load(entry.image_hash, entry.model_version) for entry in batch.entries)
+              if detections is not None]
+
+    results = []
+    for conf, iou in thresholds:
+        seedlings = 0
+        average_heights = []
+        for detections in cached:
+            filtered = filter_detections(detections, conf, iou, *detections['thresholds'])
+            eligible, heights = geometry.measure_boxes(filtered['xyxy'])
+            measurements = heights[eligible].tolist()
+            seedlings += len(measurements)
+            average_heights.append(average_height(measurements))
+        results.append({
+            'conf': conf,
+            'iou': iou,
+            'entries': len(cached),
+            'seedlings': seedlings,
+            'average_height': sum(average_heights) / len(average_heights) if average_heights else None
+        })
+    return results
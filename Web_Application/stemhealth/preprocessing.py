@@ -0,0 +1,126 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import cv2
+import numpy as np
+from werkzeug.utils import secure_filename
+from stemhealth import app
+from stemhealth.util import sharpen_image
+
+# Process pool shared by all uploads of this worker process, created on first use
+# Pool processes are spawned rather than forked: forking a process that runs threads (the job queue, the server's
+# request threads) can copy locks held by another thread into the child, which then deadlocks
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=app.config['PREPROCESS_WORKERS'],
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+# Replace the pool if it is still the given broken pool (one of its processes died, e.g. out of memory on a large
+# image), so later uploads do not all fail. Returns the current pool
+def replace_broken_pool(broken):
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+    return get_pool()
+
+# Scratch buffers reused by the sharpening of images of the same shape in a pool process
+_scratch_buffers = {}
+
+def get_scratch_buffers(shape):
+    if shape not in _scratch_buffers:
+        _scratch_buffers.clear()
+        _scratch_buffers[shape] = (np.empty(shape, dtype=np.uint8), np.empty(shape, dtype=np.uint8))
+    return _scratch_buffers[shape]
+
+# Decode, sharpen and re-encode an uploaded image in memory (runs in a pool process)
+def sharpen_image_bytes(data, extension):
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("The file could not be decoded as an image")
+
+    # Apply unsharp mask to sharpen the image as a preprocessing step
+    blurred, out = get_scratch_buffers(image.shape)
+    sharpened_image = sharpen_image(image, blurred=blurred, out=out)
+
+    success, encoded = cv2.imencode(extension, sharpened_image)
+    if not success:
+        raise ValueError(f"The image could not be encoded as {extension}")
+    return encoded.tobytes()
+
+# Write the processed image to the original and predicted image folders
+def write_image(data, *paths):
+    for path in paths:
+        with open(path, 'wb') as f:
+            f.write(data)
+
+# Sharpen the uploaded images on a process pool while the results are written to disk on a thread
+# Returns the saved (filename, original image path) pairs in upload order and the (filename, error) failures
+def preprocess_uploads(image_files, original_images_dir, predicted_images_dir):
+    pool = get_pool()
+    # Limit the number of uploads held in memory at once
+    max_in_flight = 2 * app.config['PREPROCESS_WORKERS']
+    in_flight = deque()
+    saved = []
+    failed = []
+
+    # Sharpen an image on the pool, on a new pool if the current one is broken
+    def submit(data, extension):
+        nonlocal pool
+        try:
+            return pool.submit(sharpen_image_bytes, data, extension)
+        except BrokenProcessPool:
+            pool = replace_broken_pool(pool)
+            return pool.submit(sharpen_image_bytes, data, extension)
+
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        writes = []
+
+        # Wait for the oldest image to be sharpened and queue its writes
+        def collect():
+            filename, data, extension, future = in_flight.popleft()
+            try:
+                try:
+                    processed = future.result()
+                except BrokenProcessPool:
+                    # A pool process died while this image was in flight, maybe on another image: sharpen it once more,
+                    # on a new pool, and report it as failed if that breaks as well
+                    processed = submit(data, extension).result()
+            except Exception as e:
+                failed.append((filename, str(e)))
+                return
+            original_image_filepath = os.path.join(original_images_dir, filename)
+            predicted_image_filepath = os.path.join(predicted_images_dir, filename)
+            writes.append((filename, original_image_filepath, writer.submit(write_image, processed, original_image_filepath, predicted_image_filepath)))
+
+        for file in image_files:
+            if not file or not file.filename:
+                continue
+            filename = secure_filename(file.filename)
+            extension = os.path.splitext(filename)[1].lower()
+            data = file.read()
+            in_flight.append((filename, data, extension, submit(data, extension)))
+            if len(in_flight) >= max_in_flight:
+                collect()
+        while in_flight:
+            collect()
+
+        for filename, original_image_filepath, future in writes:
+            try:
+                future.result()
+            except Exception as e:
+                failed.append((filename, str(e)))
+            else:
+                saved.append((filename, original_image_filepath))
+
+    return saved, failed
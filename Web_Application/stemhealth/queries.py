@@ -0,0 +1,214 @@
+import threading
+import numpy as np
+from sqlalchemy import case, func, select
+from stemhealth import db
+from stemhealth.models import Batch, Entry, IndividualHeight
+from stemhealth.detections import detection_heights, load_detections
+
+# Date format used on the dashboard and the batch profile page
+DISPLAY_DATE_FORMAT = '%A, %d-%m-%Y'
+# Percentiles of the seedling heights shown in the batch statistics
+HEIGHT_PERCENTILES = (25, 50, 75)
+
+# Get the preview image (the middle entry's image) of each batch in one statement
+def get_preview_images(batch_ids):
+    if not batch_ids:
+        return {}
+    numbered = (
+        select(Entry.batch_id,
+               Entry.original_image_filepath,
+               func.row_number().over(partition_by=Entry.batch_id, order_by=Entry.id).label('position'),
+               func.count().over(partition_by=Entry.batch_id).label('num_entries'))
+        .where(Entry.batch_id.in_(batch_ids))
+        .subquery()
+    )
+    # row_number() is 1-based, so the middle entry (index num_entries // 2) is at position num_entries // 2 + 1
+    statement = (
+        select(numbered.c.batch_id, numbered.c.original_image_filepath)
+        .where(numbered.c.position == numbered.c.num_entries // 2 + 1)
+    )
+    return {batch_id: image for batch_id, image in db.session.execute(statement)}
+
+# Get the dashboard summaries of the batches (latest first) with their date range, entry count and preview image
+# Pages are selected with an offset, or with keyset paging on the batch ID (before_id) for large histories
+# Returns the summaries and whether there are older batches
+def get_batch_summaries(limit, offset=0, before_id=None):
+    statement = (
+        select(Batch.id,
+               Batch.name,
+               Batch.species,
+               func.min(Entry.timestamp).label('start_timestamp'),
+               func.max(Entry.timestamp).label('end_timestamp'),
+               func.count(Entry.id).label('num_entries'))
+        .outerjoin(Entry, Entry.batch_id == Batch.id)
+        .group_by(Batch.id)
+        .order_by(Batch.id.desc())
+        .limit(limit + 1)
+    )
+    if before_id is not None:
+        statement = statement.where(Batch.id < before_id)
+    else:
+        statement = statement.offset(offset)
+
+    rows = db.session.execute(statement).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    preview_images = get_preview_images([row.id for row in rows])
+
+    summaries = []
+    for row in rows:
+        summaries.append({
+            'id': row.id,
+            'name': row.name,
+            'species': row.species,
+            'num_entries': row.num_entries,
+            'preview_image': preview_images.get(row.id),
+            'start_date': row.start_timestamp.strftime(DISPLAY_DATE_FORMAT) if row.start_timestamp else None,
+            'end_date': row.end_timestamp.strftime(DISPLAY_DATE_FORMAT) if row.end_timestamp else None
+        })
+    return summaries, has_more
+
+
+# Per-batch statistics cache of this process, holding the (version, statistics) of each batch
+# Entries can be added or measured by other processes (the CLI commands, other web workers), so cached statistics
+# are only used while the version of the batch in the database is unchanged
+_batch_stats_cache = {}
+_batch_stats_lock = threading.Lock()
+
+# Get the version of the statistics of a batch: its entry count, latest entry and latest measurement
+def get_batch_stats_version(batch_id):
+    return tuple(db.session.execute(
+        select(func.count(Entry.id), func.max(Entry.id), func.max(Entry.measured_at)).where(Entry.batch_id == batch_id)
+    ).one())
+
+def invalidate_batch_stats(batch_id):
+    with _batch_stats_lock:
+        _batch_stats_cache.pop(batch_id, None)
+
+# Format an aggregate to 2 decimals, keeping None for batches without entries
+def round_stat(value):
+    return float("{:.2f}".format(value)) if value is not None else None
+
+# Get the seedling height percentiles of a batch (nearest rank), computed by the database in one statement
+def get_height_percentiles(batch_id, num_heights):
+    if not num_heights:
+        return {}
+    ranks = {percentile: round(percentile / 100 * (num_heights - 1)) for percentile in HEIGHT_PERCENTILES}
+    numbered = (
+        select(IndividualHeight.height,
+               func.row_number().over(order_by=IndividualHeight.height).label('position'))
+        .join(Entry, IndividualHeight.entry_id == Entry.id)
+        .where(Entry.batch_id == batch_id)
+        .subquery()
+    )
+    # row_number() is 1-based, so the height at rank n is at position n + 1
+    statement = (
+        select(numbered.c.position, numbered.c.height)
+        .where(numbered.c.position.in_({rank + 1 for rank in ranks.values()}))
+    )
+    heights = {position: height for position, height in db.session.execute(statement)}
+    return {f'p{percentile}': heights.get(rank + 1) for percentile, rank in ranks.items()}
+
+# Get the seedling heights of the entries of a batch stored as compact detections
+def get_compact_heights(batch_id):
+    blobs = db.session.execute(
+        select(Entry.detections).where(Entry.batch_id == batch_id, Entry.detections.isnot(None))
+    ).scalars()
+    heights = [detection_heights(load_detections(blob)) for blob in blobs]
+    return np.concatenate(heights) if heights else np.empty(0)
+
+# Compute the seedling height statistics of a batch with NumPy, used when some of its entries store compact detections
+def compute_height_stats(batch_id, compact_heights):
+    table_heights = db.session.execute(
+        select(IndividualHeight.height)
+        .join(Entry, IndividualHeight.entry_id == Entry.id)
+        .where(Entry.batch_id == batch_id)
+    ).scalars()
+    heights = np.sort(np.concatenate([np.fromiter(table_heights, dtype=np.float64), compact_heights]))
+    height_stats = {
+        'num_heights': len(heights),
+        'avg_height': round_stat(heights.mean()),
+        'min_height': float(heights[0]),
+        'max_height': float(heights[-1])
+    }
+    # Nearest rank percentiles, as computed by get_height_percentiles
+    for percentile in HEIGHT_PERCENTILES:
+        height_stats[f'p{percentile}'] = float(heights[round(percentile / 100 * (len(heights) - 1))])
+    return height_stats
+
+# Compute the statistics of a batch with SQL aggregates (and NumPy for compact detections)
+def compute_batch_stats(batch_id):
+    entry_stats = db.session.execute(
+        select(func.count(Entry.id).label('num_entries'),
+               func.min(Entry.timestamp).label('start_timestamp'),
+               func.max(Entry.timestamp).label('end_timestamp'),
+               func.avg(Entry.temperature).label('avg_temperature'),
+               func.min(Entry.temperature).label('min_temperature'),
+               func.max(Entry.temperature).label('max_temperature'),
+               func.avg(Entry.humidity).label('avg_humidity'),
+               func.min(Entry.humidity).label('min_humidity'),
+               func.max(Entry.humidity).label('max_humidity'),
+               func.count(case((Entry.average_height != 0, 1))).label('measured_entries'),
+               func.coalesce(func.sum(Entry.predicted_seedlings), 0).label('total_seedlings'))
+        .where(Entry.batch_id == batch_id)
+    ).one()
+    compact_heights = get_compact_heights(batch_id)
+    if len(compact_heights):
+        height_stats = compute_height_stats(batch_id, compact_heights)
+    else:
+        height_row = db.session.execute(
+            select(func.count(IndividualHeight.id).label('num_heights'),
+                   func.avg(IndividualHeight.height).label('avg_height'),
+                   func.min(IndividualHeight.height).label('min_height'),
+                   func.max(IndividualHeight.height).label('max_height'))
+            .join(Entry, IndividualHeight.entry_id == Entry.id)
+            .where(Entry.batch_id == batch_id)
+        ).one()
+        height_stats = {
+            'num_heights': height_row.num_heights,
+            'avg_height': round_stat(height_row.avg_height),
+            'min_height': height_row.min_height,
+            'max_height': height_row.max_height
+        }
+        height_stats.update(get_height_percentiles(batch_id, height_row.num_heights))
+
+    stats = {
+        'num_entries': entry_stats.num_entries,
+        'start_date': entry_stats.start_timestamp.strftime(DISPLAY_DATE_FORMAT) if entry_stats.start_timestamp else None,
+        'end_date': entry_stats.end_timestamp.strftime(DISPLAY_DATE_FORMAT) if entry_stats.end_timestamp else None,
+        'avg_temperature': round_stat(entry_stats.avg_temperature),
+        'min_temperature': entry_stats.min_temperature,
+        'max_temperature': entry_stats.max_temperature,
+        'avg_humidity': round_stat(entry_stats.avg_humidity),
+        'min_humidity': entry_stats.min_humidity,
+        'max_humidity': entry_stats.max_humidity,
+        'measured_entries': entry_stats.measured_entries,
+        'total_seedlings': entry_stats.total_seedlings
+    }
+    stats.update(height_stats)
+    return stats
+
+# Get the statistics of a batch, from the cache if they were computed since the batch last changed
+def get_batch_stats(batch_id):
+    version = get_batch_stats_version(batch_id)
+    with _batch_stats_lock:
+        cached = _batch_stats_cache.get(batch_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    stats = compute_batch_stats(batch_id)
+    with _batch_stats_lock:
+        _batch_stats_cache[batch_id] = (version, stats)
+    return stats
+
+# Get one page of the measured entries of a batch, in timestamp order
+# Returns the entries and whether there are more
+def get_entries_page(batch_id, page, per_page):
+    entries = (
+        Entry.query
+        .filter(Entry.batch_id == batch_id, Entry.predicted_image_filepath.isnot(None))
+        .order_by(Entry.timestamp, Entry.id)
+        .offset((page - 1) * per_page)
+        .limit(per_page + 1)
+        .all()
+    )
+    return entries[:per_page], len(entries) > per_page
@@ -1,31 +1,17 @@
 import json
 import os
-from flask import jsonify, render_template, url_for, flash, redirect, request
+from flask import Response, jsonify, stream_with_context, render_template, url_for, flash, redirect, request
 from stemhealth import app, db
 from werkzeug.utils import secure_filename
-import datetime as dt
-from stemhealth.models import Batch, Entry, IndividualHeight
-from sqlalchemy import func
-from ultralytics import YOLO
-import ultralytics
-import cv2
-from stemhealth import measurement
+from stemhealth.models import Batch, Entry
+from stemhealth import pipeline
+from stemhealth.ingest import ALLOWED_IMAGE_EXTENSIONS, ALLOWED_JSON_EXTENSIONS, add_entries, make_batch_dirs
+from stemhealth.jobs import JobConflict, job_queue
+from stemhealth.graphs import get_batch_graphs
+from stemhealth.export import EXPORT_COLUMNS, EXPORT_FORMATS, available_formats, export_filename, iter_export
+from stemhealth.queries import get_batch_summaries, get_batch_stats, get_entries_page, invalidate_batch_stats
+from stemhealth.series import DOWNSAMPLE_METHODS, SERIES_COLUMNS, downsample_series, load_series, series_json, series_version
 from stemhealth.util import *
-import pandas as pd
-from torch.serialization import add_safe_globals
-import torch
-
-# Define constants
-ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
-ALLOWED_JSON_EXTENSIONS = {'json'} 
-REFERENCE_OBJECT = "reference_object.png"
-MODEL_PATH = 'model/best.pt'
-
-# Obtain the reference object mask
-reference_mask, simplified_reference_mask, simplified_reference_mask_approx = measurement.get_reference_object_mask(os.path.join(app.static_folder, REFERENCE_OBJECT))
-# Allowlist YOLO SegmentationModel so torch.load() can unpickle it
-add_safe_globals([ultralytics.nn.tasks.SegmentationModel])
-add_safe_globals([torch.nn.modules.container.Sequential])
 
 # Upload Page
 # Upload page route
@@ -40,8 +26,7 @@ def check_name():
     name = request.args.get('name').strip()
     if name:
         # Check if any batch with the given name exists in the database
-        existing_batch = Batch.query.filter(func.lower(Batch.name) == name.lower()).first()
-        print(name.lower())
+        existing_batch = Batch.query.filter_by(name_key=Batch.normalize_name(name)).first()
         if existing_batch:
             return jsonify({'exists': True})
     return jsonify({'exists': False})
@@ -57,7 +42,7 @@ def upload_data():
         image_files = request.files.getlist('file')
 
         # Check if a batch with the given name already exists
-        existing_batch = Batch.query.filter(func.lower(Batch.name) == name.lower()).first()
+        existing_batch = Batch.query.filter_by(name_key=Batch.normalize_name(name)).first()
         if existing_batch:
             flash('A batch with this name already exists. Please choose a different name.', 'error')
             return render_template('upload.html', species=species, environmental_data=env_data_file, files=image_files)
@@ -75,98 +60,103 @@ def upload_data():
             flash('Invalid file type detected. Only PNG, JPG, and JPEG files are allowed.', 'danger')
             return redirect(request.url)
         
-        # Create directories for the batch to store the uploaded data
-        batch_dir = os.path.join(app.config['UPLOAD_FOLDER'], name.replace(' ', '_'))
-        os.makedirs(batch_dir, exist_ok=True)      
-        # Create directories for the original and predicted images  
-        original_images_dir = os.path.join(batch_dir, 'original_images')
-        os.makedirs(original_images_dir, exist_ok=True)
-        predicted_images_dir = os.path.join(batch_dir, 'predicted_images')
-        os.makedirs(predicted_images_dir, exist_ok=True)
+        # Create directories for the batch to store the uploaded data (with the original and predicted images)
+        batch_dir, _, _ = make_batch_dirs(name)
         env_data_filepath = os.path.join(batch_dir, env_data_filename)
         env_data_file.save(env_data_filepath)
         
-        # Create a new batch in the database
+        # Create a new batch in the database (committed together with its entries)
         batch = Batch(name=name, species=species)
         db.session.add(batch)
-        db.session.commit()
+        db.session.flush()
         
-        # Load the environmental data from the JSON file
+        # Load the environmental data from the JSON file and index it by filename
         with open(env_data_filepath, 'r') as json_file:
             env_data = json.load(json_file)
+        env_index = index_environmental_data(env_data)
 
-        # Sort the environmental data by timestamp (earliest to latest)
-        env_data_sorted = sorted(env_data, key=lambda x: dt.datetime.strptime(x['timestamp'], "%d-%m-%Y_%H-%M-%S"))
-        
-        # Process the uploaded images
-        for file in image_files:
-            if file and allowed_file(file.filename, ALLOWED_IMAGE_EXTENSIONS):
-                filename = secure_filename(file.filename)
-                original_image_filepath = os.path.join(original_images_dir, filename)
-                predicted_image_filepath = os.path.join(predicted_images_dir, filename)
-                # Read the image
-                file.save(original_image_filepath)
-                
-                # Apply unsharp mask to sharpen the image as a preprocessing step
-                sharpened_image = sharpen_image(original_image_filepath)
-
-                # Save the processed image
-                cv2.imwrite(original_image_filepath, sharpened_image)
-                cv2.imwrite(predicted_image_filepath, sharpened_image)
-                
-                # Extract the timestamp, temperature, and humidity from the environmental data
-                for item in env_data_sorted:
-                    if item['filename'] == filename:
-                        timestamp = dt.datetime.strptime(item['timestamp'], "%d-%m-%Y_%H-%M-%S")
-                        relative_image_path = os.path.relpath(original_image_filepath, app.static_folder)  # Get relative path to static folder
-                        temperature = item['temperature']
-                        humidity = item['humidity']
-                        entry = Entry(original_image_filepath=relative_image_path, 
-                                      timestamp=timestamp, 
-                                      temperature=temperature, 
-                                      humidity=humidity, 
-                                      batch_id=batch.id)
-                        
-                        db.session.add(entry)
-                        db.session.commit()
+        # Sharpen and save the uploaded images in parallel and insert their entries in one transaction
+        num_added, failed_images, missing_env_data, duplicates = add_entries(batch, image_files, env_index)
+        db.session.commit()
+        for filename, error in failed_images:
+            flash(f'{filename} could not be processed: {error}', 'error')
+
+        if missing_env_data:
+            flash(f'No environmental data was found for {len(missing_env_data)} image(s), which were not added: {", ".join(missing_env_data)}', 'error')
         
-        # Flash a success message and redirect to the dashboard 
-        flash('Files uploaded successfully.', 'success')
+        # Flash a success message if any entry was added (a warning with the counts otherwise) and redirect to the dashboard
+        if num_added:
+            flash('Files uploaded successfully.', 'success')
+        else:
+            flash(f'No images were added: {len(failed_images)} could not be processed, {len(missing_env_data)} had no '
+                  f'environmental data and {len(duplicates)} were duplicates.', 'warning')
         return redirect(url_for('dashboard'))
 
 
+# Method for appending new frames (images and their environmental data) to an existing batch, e.g. from a capture rig
+# Optionally queues the measurement of the batch, which only measures the new frames
+@app.route('/batch/<int:batch_id>/append', methods=['POST'])
+def append_data(batch_id):
+    batch = Batch.query.filter_by(id=batch_id).first_or_404()
+    env_data_file = request.files.get('environmental_data')
+    image_files = request.files.getlist('file')
+    measure = request.args.get('measure', 0, type=int) == 1
+
+    # Validate the uploaded files
+    if not env_data_file or not allowed_file(secure_filename(env_data_file.filename), ALLOWED_JSON_EXTENSIONS):
+        return jsonify({'success': False, 'error': 'Invalid environmental data file. Please upload a JSON file.'}), 400
+    invalid_files = [file.filename for file in image_files if not allowed_file(file.filename, ALLOWED_IMAGE_EXTENSIONS)]
+    if invalid_files:
+        return jsonify({'success': False, 'error': f'Invalid file type: {", ".join(invalid_files)}. Only PNG, JPG, and JPEG files are allowed.'}), 400
+    try:
+        env_index = index_environmental_data(json.load(env_data_file))
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'success': False, 'error': f'Invalid environmental data: {e}'}), 400
+
+    # Store the new frames, then update the optimum duration and statistics of the batch
+    num_added, failed_images, missing_env_data, duplicates = add_entries(batch, image_files, env_index)
+    if num_added:
+        calculate_optimum_duration(batch)
+    db.session.commit()
+    invalidate_batch_stats(batch.id)
+
+    response = {
+        'success': True,
+        'added': num_added,
+        'failed': [{'filename': filename, 'error': error} for filename, error in failed_images],
+        'missing_environmental_data': missing_env_data,
+        'skipped': duplicates
+    }
+    if measure and num_added:
+        try:
+            job = submit_measurement(batch.id)
+        except JobConflict as e:
+            # The frames are added, but are left for the next measurement
+            job = e.job
+            response['measure_error'] = str(e)
+        response['job_id'] = job.id
+        response['status_url'] = url_for('job_status', job_id=job.id)
+    return jsonify(response), 201 if num_added else 200
+
+
 # Dashboard Page
 # Route for the dashboard (home page)
 @app.route('/')
 @app.route('/dashboard')
 def dashboard():
-    batches = Batch.query.all()
-    batch_data = []
-
-    # Display the batches in reverse order (latest first)
-    for batch in reversed(batches):
-        # Get the start and end dates of the batch
-        start_date, end_date = get_start_end_dates(batch.entries)
-
-        # Get preview image 
-        preview_image = batch.entries[len(batch.entries)//2].original_image_filepath
-        print(preview_image)
-
-        # Append the batch data to the list to be displayed
-        batch_data.append({
-            'id': batch.id,
-            'name': batch.name,
-            'species': batch.species,
-            'preview_image': preview_image,
-            'start_date': start_date,
-            'end_date': end_date
-        })
+    # Get one page of batch summaries (latest first), by keyset (before) or page number
+    per_page = app.config['DASHBOARD_PAGE_SIZE']
+    before_id = request.args.get('before', type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+    batch_data, has_more = get_batch_summaries(per_page, offset=(page - 1) * per_page, before_id=before_id)
+    older_batches_id = batch_data[-1]['id'] if has_more else None
 
     # Render the dashboard template based on the presence of batches
-    if not batches:
+    if not batch_data:
         return render_template('dashboard.html', page_title='Dashboard')
     else:
-        return render_template('dashboard.html', page_title='Dashboard', batch_data = batch_data)
+        return render_template('dashboard.html', page_title='Dashboard', batch_data = batch_data,
+                               older_batches_id=older_batches_id, is_first_page=before_id is None and page == 1)
 
 
 # Batch Profile Page
@@ -175,162 +165,159 @@ def dashboard():
 def batch_detail(batch_id):
     # Get the batch details from the database based on the batch ID
     batch = Batch.query.filter_by(id=batch_id).first_or_404()    
-    entries = batch.entries 
-    start_date, end_date = get_start_end_dates(entries)
-    num_entries = len(entries)
-    # Calculate the average temperature and humidity
-    if num_entries > 0:
-        avg_temperature = float("{:.2f}".format(sum(entry.temperature for entry in entries) / num_entries))
-        avg_humidity = float("{:.2f}".format(sum(entry.humidity for entry in entries) / num_entries))
+    # Get the batch statistics (dates, averages, measured entries) computed by the database
+    stats = get_batch_stats(batch.id)
+    # Get the first page of entries, the rest are loaded by the page when requested
+    entries, has_more_entries = get_entries_page(batch.id, 1, app.config['ENTRIES_PAGE_SIZE'])
+    optimum_entry = db.session.get(Entry, batch.optimum_entry_id) if batch.optimum_entry_id else None
 
     # Check if measurements/predictions have been done for the batch
-    has_predictions = any(entry.average_height for entry in entries)
-    graphs_paths = []
-    
-    # Check if the CSV data and graphs exist for the batch
-    csv_base_path = os.path.join(app.static_folder, 'seedling_data', batch.name.replace(' ', '_'), 'csv_data')
-    csv_exists = os.path.exists(os.path.join(csv_base_path, f"{batch.name.replace(' ', '_')}_entries.csv"))
+    has_predictions = stats['measured_entries'] > 0
+    graphs = []
+    graphs_pending = False
 
-    graphs_folder = os.path.join(app.static_folder, 'seedling_data', batch.name.replace(' ', '_'), 'graphs_folder')
-    graphs_exist = os.path.exists(graphs_folder) and os.listdir(graphs_folder)
-
-    # Generate the CSV data and graphs if they do not exist
+    # Get the graphs (re-rendered in the background when the data changed)
     if has_predictions:
-        if not csv_exists or not graphs_exist:
-            if not csv_exists:
-                csv_batch_file_path, csv_entries_file_path, _ = save_batch_data_to_csv(batch)
-            
-            if not graphs_exist:
-                batch_data = pd.read_csv(csv_batch_file_path)
-                entry_data = pd.read_csv(csv_entries_file_path)
-                ensure_graphs_generated(batch_data, entry_data, graphs_folder)
-    
-    # Determine if the graphs exist again after generation
-    graphs_exist = os.path.exists(graphs_folder) and os.listdir(graphs_folder)
-
-    # Get the paths of the graphs to be displayed
-    if graphs_exist:
-        graphs_paths = [os.path.relpath(os.path.join(graphs_folder, graph), app.static_folder) for graph in os.listdir(graphs_folder)]
+        graphs, graphs_pending = get_batch_graphs(batch)
 
     return render_template('batch_profile.html',
                            page_title=batch.name,
                            batch=batch,
                            entries=entries,
-                           start_date=start_date,
-                           end_date=end_date,
-                           num_entries=num_entries,
-                           avg_temperature=avg_temperature,
-                           avg_humidity=avg_humidity,
+                           has_more_entries=has_more_entries,
+                           optimum_entry=optimum_entry,
+                           stats=stats,
+                           start_date=stats['start_date'],
+                           end_date=stats['end_date'],
+                           num_entries=stats['num_entries'],
+                           avg_temperature=stats['avg_temperature'],
+                           avg_humidity=stats['avg_humidity'],
                            has_predictions=has_predictions,
-                           graphs_paths=graphs_paths)
+                           graphs=graphs,
+                           graphs_pending=graphs_pending)
+
+# Method to get a page of the measured entries of a batch
+@app.route('/batch/<int:batch_id>/entries', methods=['GET'])
+def batch_entries(batch_id):
+    batch = Batch.query.filter_by(id=batch_id).first_or_404()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(request.args.get('per_page', app.config['ENTRIES_PAGE_SIZE'], type=int), app.config['ENTRIES_PAGE_SIZE_MAX'])
+    entries, has_more = get_entries_page(batch.id, page, per_page)
 
-# Method to perform predictions on a batch
-@app.route('/predict', methods=['GET'])
+    entries_data = []
+    for entry in entries:
+        entry_data = entry.to_dict()
+        entry_data['original_image_url'] = url_for('static', filename=entry.original_image_filepath.replace('\\', '/'))
+        entry_data['predicted_image_url'] = url_for('static', filename=entry.predicted_image_filepath.replace('\\', '/'))
+        entries_data.append(entry_data)
+    return jsonify({'success': True, 'entries': entries_data, 'page': page, 'has_more': has_more})
+
+# Method to get the time series of a batch as columnar JSON, for charting in the browser
+# Optional query parameters: columns (comma separated), points (downsample to about this many points),
+# method (lttb or minmax) and by (the column the downsampled points are chosen by)
+@app.route('/api/batch/<int:batch_id>/series', methods=['GET'])
+def batch_series(batch_id):
+    batch = Batch.query.filter_by(id=batch_id).first_or_404()
+    columns = [column for column in request.args.get('columns', ','.join(SERIES_COLUMNS)).split(',') if column]
+    points = request.args.get('points', type=int)
+    method = request.args.get('method', 'lttb')
+    by = request.args.get('by', columns[0] if columns else '')
+    if not columns or any(column not in SERIES_COLUMNS for column in columns):
+        return jsonify({'success': False, 'error': f'Columns must be among: {", ".join(SERIES_COLUMNS)}'}), 400
+    if method not in DOWNSAMPLE_METHODS:
+        return jsonify({'success': False, 'error': f'Method must be one of: {", ".join(DOWNSAMPLE_METHODS)}'}), 400
+    if by not in columns:
+        return jsonify({'success': False, 'error': 'The downsampling column must be one of the requested columns'}), 400
+    if points is not None:
+        points = max(min(points, app.config['SERIES_MAX_POINTS']), 1)
+
+    timestamps, values = load_series(batch.id, columns)
+    # Answer with 304 Not Modified when the client already has this version of the series
+    version = series_version(timestamps, values, {'columns': columns, 'points': points, 'method': method, 'by': by})
+    if version in request.if_none_match:
+        response = Response(status=304)
+    else:
+        total_points = len(timestamps)
+        if points is not None:
+            timestamps, values = downsample_series(timestamps, values, points, method=method, by=by)
+        response = Response(series_json(batch.id, timestamps, values, total_points), mimetype='application/json')
+    response.set_etag(version)
+    # Let browsers keep the series but check its version before each use
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# Queue the measurement of a batch; its options identify the job, so a request with other options cannot join it
+def submit_measurement(batch_id, model_version=None, force=False, from_cache=False, conf=pipeline.PREDICT_CONF, iou=pipeline.PREDICT_IOU):
+    params = {'model_version': model_version or app.config['DEFAULT_MODEL_VERSION'], 'force': force,
+              'from_cache': from_cache, 'conf': conf, 'iou': iou}
+    return job_queue.submit('measure', batch_id, pipeline.measure_batch, batch_id, params=params, **params)
+
+# Method to start the predictions on a batch as a background job
+@app.route('/predict', methods=['GET', 'POST'])
 def predict_batch():
     # Get the batch ID from the request
     batch_id = request.args.get('batch_id', type=int)
     # Get the batch details from the database based on the batch ID
     batch = Batch.query.filter_by(id=batch_id).first_or_404()
-    entries = batch.entries
-    # Get the sponge mask
-    sponge_image_path = os.path.join(app.static_folder, entries[0].original_image_filepath)
-    _, simplified_sponge_mask, simplified_sponge_mask_approx = measurement.get_sponge_mask(sponge_image_path)
-    # Define the model paths and image paths
-    model = YOLO(os.path.join(app.static_folder, MODEL_PATH))
-    print(model.model.yaml)
-    batch_path = os.path.join(app.static_folder, 'seedling_data', batch.name.replace(' ', '_'))
-    original_images_path = os.path.join(batch_path, 'original_images')
-    predicted_images_path = os.path.join(batch_path, 'predicted_images')
-    
-    # Perform predictions on the images in the batch
-    results = model.predict(original_images_path, show_labels=False, line_width=1, iou=0.65, conf=0.5)    
-    
-    # Process the predictions and save the individual heights
-    for i in range(len(results)):
-        result = results[i]
-        boxes = result.boxes
-        entry = entries[i]
-        measurements = []
-        # predicted_seedlings = len(boxes) if boxes else 0
-        predicted_seedlings = 0
-
-        # Get the filename of the predicted image
-        predicted_image_filename = os.path.basename(result.path)
-        predicted_image_rel_path = os.path.relpath(os.path.join(predicted_images_path, predicted_image_filename), app.static_folder)
-        entry.predicted_image_filepath = predicted_image_rel_path
-
-        # Check if any seedlings were detected
-        if boxes:
-            original_image = cv2.imread(os.path.join(app.static_folder, entry.original_image_filepath))
-
-            for box in boxes:
-                # Get the bounding box coordinates
-                xyxy = box.xyxy[0].tolist()
-                x1, y1, x2, y2 = map(int, xyxy)
-                height = int(y2 - y1)
-                width = int(x2 - x1)
-                confidence = box.conf[0].item()  # Get the confidence score
-                class_id = box.cls[0].item()  # Get the class ID
-                class_name = model.names[int(class_id)]  # Get the class name
-
-                # Check if the seedling is within the eligible area and has a height greater than the width
-                eligible_area_mask = measurement.find_eligible_seedling_position(simplified_reference_mask, simplified_sponge_mask, simplified_reference_mask_approx, simplified_sponge_mask_approx)
-                if measurement.is_within_mask(eligible_area_mask, (x2, y2)) and (height > width):
-                    # Calculate the predicted height
-                    predicted_height = measurement.process_image(simplified_reference_mask, x1, y1, x2, y2)
-                    cv2.rectangle(original_image, (x1, y1), (x2, y2), (248, 4, 8), 1)
-                    predicted_seedlings += 1
-                    measurements.append(predicted_height)
-                    # Save the individual height along with YOLO prediction details
-                    individual_height = IndividualHeight(
-                        height=predicted_height,
-                        label=class_name,
-                        confidence=confidence,
-                        x1=x1,
-                        y1=y1,
-                        x2=x2,
-                        y2=y2,
-                        entry_id=entry.id
-                    )
-                    db.session.add(individual_height)
-            cv2.imwrite(os.path.join(predicted_images_path, predicted_image_filename), original_image)
-   
-        entry.predicted_seedlings = predicted_seedlings
-        # Calculate the average height for the entry
-        if measurements:
-            average_height = float("{:.2f}".format(sum(measurements) / len(measurements)))
-            entry.average_height = average_height
-        else: # If no seedlings were detected, set the average height to 0 and predicted seedlings to 0
-            entry.average_height = 0.0
-            entry.predicted_seedlings = 0
-            
-    # Commit the individual heights and entry updates
-    db.session.commit()
-    
-    # Calculate and update the optimum duration for the batch
-    calculate_optimum_duration(batch)
-    db.session.commit()
-    
-    # Return a success response 
-    return jsonify({'success': True})
+    # Get the model version to measure the batch with (the default model if not given)
+    model_version = request.args.get('model', app.config['DEFAULT_MODEL_VERSION'])
+    if model_version not in app.config['MODEL_VERSIONS']:
+        return jsonify({'success': False, 'error': f'Unknown model version: {model_version}'}), 400
 
-# Method to obtain the CSV data file path for a batch to be downloaded
+    # Measure all the entries again (rather than only the new or changed ones) if requested
+    force = request.args.get('force', 0, type=int) == 1
+    # Measure from the raw detections cached by the last predictions instead of the model, with optional thresholds
+    from_cache = request.args.get('from_cache', 0, type=int) == 1
+    conf = request.args.get('conf', pipeline.PREDICT_CONF, type=float)
+    iou = request.args.get('iou', pipeline.PREDICT_IOU, type=float)
+    if not (0 <= conf <= 1 and 0 <= iou <= 1):
+        return jsonify({'success': False, 'error': 'conf and iou must be between 0 and 1'}), 400
+
+    # Queue the measurement and return the job ID straight away
+    try:
+        job = submit_measurement(batch.id, model_version=model_version, force=force, from_cache=from_cache, conf=conf, iou=iou)
+    except JobConflict as e:
+        return jsonify({'success': False, 'error': str(e), 'job_id': e.job.id,
+                        'status_url': url_for('job_status', job_id=e.job.id)}), 409
+    return jsonify({'success': True, 'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id)}), 202
+
+# Method to get the progress of a background job
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Unknown job'}), 404
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+# Method to obtain the download URLs of the CSV data of a batch
 @app.route('/download_csv', methods=['GET'])
 def download_csv():
     # Get the batch ID from the request and retrieve the batch details based on the ID
     batch_id = request.args.get('batch_id', type=int)
     batch = Batch.query.filter_by(id=batch_id).first_or_404()
-    
-    # Define the paths for the CSV files
-    base_path = os.path.join('seedling_data', batch.name.replace(' ', '_'), 'csv_data')
-    csv_batch_file_path = os.path.join(base_path, f"{batch.name.replace(' ', '_')}_batch.csv")
-    csv_entries_file_path = os.path.join(base_path, f"{batch.name.replace(' ', '_')}_entry.csv")
-    csv_individual_heights_file_path = os.path.join(base_path, f"{batch.name.replace(' ', '_')}_individual_height.csv")
-    
-    # Return the file paths as a JSON response
+    export_format = request.args.get('format', 'csv')
+    if export_format not in available_formats():
+        return jsonify({'success': False, 'error': f'Format must be one of: {", ".join(available_formats())}'}), 400
+
+    # Return the export URLs as a JSON response, the files are streamed from the database when downloaded
     return jsonify({
-        'success': True, 
-        'csv_batch_file_path': csv_batch_file_path,
-        'csv_entries_file_path': csv_entries_file_path,
-        'csv_individual_heights_file_path': csv_individual_heights_file_path
+        'success': True,
+        'csv_batch_file_path': url_for('export_batch', batch_id=batch.id, table='batch', format=export_format),
+        'csv_entries_file_path': url_for('export_batch', batch_id=batch.id, table='entry', format=export_format),
+        'csv_individual_heights_file_path': url_for('export_batch', batch_id=batch.id, table='individual_height', format=export_format)
     })
+
+# Method to download a table (batch, entry or individual_height) of a batch as CSV, gzipped CSV or Parquet
+# The file is streamed in chunks read from the database, so memory use does not grow with the batch size
+@app.route('/batch/<int:batch_id>/export/<table>', methods=['GET'])
+def export_batch(batch_id, table):
+    batch = Batch.query.filter_by(id=batch_id).first_or_404()
+    export_format = request.args.get('format', 'csv')
+    if table not in EXPORT_COLUMNS:
+        return jsonify({'success': False, 'error': f'Table must be one of: {", ".join(EXPORT_COLUMNS)}'}), 404
+    if export_format not in available_formats():
+        return jsonify({'success': False, 'error': f'Format must be one of: {", ".join(available_formats())}'}), 400
+
+    response = Response(stream_with_context(iter_export(batch.id, table, export_format)), mimetype=EXPORT_FORMATS[export_format][1])
+    response.headers['Content-Disposition'] = f'attachment; filename="{export_filename(batch, table, export_format)}"'
+    return response
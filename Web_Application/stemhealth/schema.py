@@ -0,0 +1,52 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+from stemhealth import app, db
+from stemhealth.models import Batch
+
+# Add the model columns missing from an existing database (SQLite can only add nullable columns)
+def add_missing_columns(connection):
+    inspector = inspect(connection)
+    added = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+            added.append((table.name, column.name))
+    return added
+
+# Fill in the name key of the batches created before the column existed
+def backfill_batch_name_keys(connection):
+    taken = {row.name_key for row in connection.execute(text("SELECT name_key FROM batch WHERE name_key IS NOT NULL"))}
+    rows = connection.execute(text("SELECT id, name FROM batch WHERE name_key IS NULL ORDER BY id")).all()
+    for batch_id, name in rows:
+        name_key = Batch.normalize_name(name)
+        # Duplicate names (ignoring case) keep a NULL key so the unique index can still be created
+        if name_key in taken:
+            app.logger.warning("Batch %s has a duplicate name '%s', leaving its name key empty.", batch_id, name)
+            continue
+        taken.add(name_key)
+        connection.execute(text("UPDATE batch SET name_key = :name_key WHERE id = :id"), {'name_key': name_key, 'id': batch_id})
+
+# Create the model indexes missing from an existing database
+def create_missing_indexes(connection):
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(connection, checkfirst=True)
+            except IntegrityError as e:
+                app.logger.warning("Could not create index %s: %s", index.name, e)
+
+# Bring a database created by an older version of the application up to date with the models
+# Run by "flask upgrade-db" and "python app.py" rather than on import, so the worker processes of a server never run
+# the DDL concurrently. Returns the (table, column) pairs added
+def upgrade_schema():
+    with db.engine.begin() as connection:
+        added = add_missing_columns(connection)
+        backfill_batch_name_keys(connection)
+        create_missing_indexes(connection)
+    return added
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import numpy as np
+from sqlalchemy import select
+from stemhealth import db
+from stemhealth.models import Entry
+
+# Entry columns served by the time-series API, in their default order
+SERIES_COLUMNS = ('average_height', 'temperature', 'humidity')
+# Downsampling methods of the time-series API
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+# Fewest points each downsampling method can return
+LTTB_MIN_POINTS = 3
+MINMAX_MIN_POINTS = 4
+
+# Load the time series of a batch in timestamp order
+# Returns the timestamps (milliseconds since the epoch) and a float array per column (NaN where missing)
+def load_series(batch_id, columns=SERIES_COLUMNS):
+    rows = db.session.execute(
+        select(Entry.timestamp, *[getattr(Entry, column) for column in columns])
+        .where(Entry.batch_id == batch_id)
+        .order_by(Entry.timestamp, Entry.id)
+    ).all()
+    timestamps = np.array([row[0] for row in rows], dtype='datetime64[ms]').astype(np.int64)
+    values = {}
+    for i, column in enumerate(columns, start=1):
+        values[column] = np.array([row[i] for row in rows], dtype=float)
+    return timestamps, values
+
+# Version of a series response: a hash of the data it is built from and the request options
+def series_version(timestamps, values, options):
+    sha = hashlib.sha256(json.dumps(options, sort_keys=True).encode())
+    sha.update(timestamps.tobytes())
+    for column in sorted(values):
+        sha.update(column.encode())
+        sha.update(values[column].tobytes())
+    return sha.hexdigest()[:16]
+
+# Bucket boundaries splitting the points between the first and last point into num_buckets buckets
+def bucket_bounds(num_points, num_buckets):
+    return (np.arange(num_buckets + 1) * (num_points - 2) / num_buckets).astype(np.int64) + 1
+
+# Largest-Triangle-Three-Buckets: pick the point of each bucket forming the largest triangle with the
+# previously picked point and the average of the next bucket, which keeps the visual shape of the line
+# At least 3 points are kept (the first, the last and one bucket), smaller counts are raised to it
+def lttb_indices(x, y, num_points):
+    n = len(x)
+    num_points = max(num_points, LTTB_MIN_POINTS)
+    if num_points >= n:
+        return np.arange(n)
+    # Missing values are treated as zero when picking points; they are still returned as missing
+    x = x.astype(float)
+    y = np.nan_to_num(y)
+    bounds = bucket_bounds(n, num_points - 2)
+    indices = np.empty(num_points, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    previous = 0
+    for i in range(num_points - 2):
+        start, end = bounds[i], bounds[i + 1]
+        if i + 2 < len(bounds):
+            next_start, next_end = bounds[i + 1], bounds[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        areas = np.abs((x[previous] - avg_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (avg_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        indices[i + 1] = previous
+    return indices
+
+# Min/max bucketing: keep the lowest and highest point of each bucket, which keeps every spike
+# At least 4 points are kept (the first, the last and the minimum and maximum of one bucket)
+def minmax_indices(y, num_points):
+    n = len(y)
+    num_points = max(num_points, MINMAX_MIN_POINTS)
+    if num_points >= n:
+        return np.arange(n)
+    y = np.nan_to_num(y)
+    bounds = bucket_bounds(n, (num_points - 2) // 2)
+    indices = [0]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == end:
+            continue
+        bucket = y[start:end]
+        indices.extend(sorted({start + int(np.argmin(bucket)), start + int(np.argmax(bucket))}))
+    indices.append(n - 1)
+    return np.array(indices, dtype=np.int64)
+
+# Downsample the series to about num_points points, choosing the points by the given column
+def downsample_series(timestamps, values, num_points, method='lttb', by='average_height'):
+    if method == 'minmax':
+        indices = minmax_indices(values[by], num_points)
+    else:
+        indices = lttb_indices(timestamps, values[by], num_points)
+    return timestamps[indices], {column: column_values[indices] for column, column_values in values.items()}
+
+# Convert an array to a JSON list, with null for missing values
+def to_json_list(values):
+    return [None if np.isnan(value) else value for value in values.tolist()]
+
+# Build the compact columnar JSON body of a series response
+def series_json(batch_id, timestamps, values, total_points):
+    body = {
+        'success': True,
+        'batch_id': batch_id,
+        'total_points': total_points,
+        'num_points': len(timestamps),
+        'timestamp': timestamps.tolist()
+    }
+    for column, column_values in values.items():
+        body[column] = to_json_list(column_values)
+    return json.dumps(body, separators=(',', ':'))
@@ -35,14 +35,34 @@ async function measureBatch(batchId) {
         predictButton.textContent = 'Measuring...';
         predictButton.disabled = true;    
 
-        // Perform the measurement by sending a request to the server
-        const response = await axios.get('/predict', { params: { batch_id: batchId } });
+        // Start the measurement job on the server and poll its progress until it finishes
+        let response;
+        try {
+            response = await axios.post('/predict', null, { params: { batch_id: batchId } });
+        } catch (error) {
+            // A measurement of this batch with other options is already running
+            if (error.response && error.response.status === 409) {
+                spinnerContainer.style.display = 'none';
+                measurementMessage.textContent = `${error.response.data.error}. Try again once it has finished.`;
+                measurementMessage.style.display = 'block';
+                predictButton.textContent = 'Measure';
+                predictButton.disabled = false;
+                return;
+            }
+            throw error;
+        }
+        const job = await pollJob(response.data.status_url, spinnerText);
 
-        if (response) {
+        if (job.status === 'completed') {
 
-            // Hide the spinner and show the completion message
+            // Hide the spinner and show the completion message, with the number of entries that could not be measured
             if (spinnerContainer) spinnerContainer.style.display = 'none';
             if (completionContainer) completionContainer.style.display = 'flex';
+            if (job.errors.length) {
+                console.error('Entries not measured:', job.errors);
+                document.getElementById('completion-text').textContent =
+                    `Measurement complete, but ${job.errors.length} of ${job.total} entries could not be measured.`;
+            }
 
             // Change the button text to "View Results"
             if (predictButton) {
@@ -54,7 +74,7 @@ async function measureBatch(batchId) {
             }
 
         } else {
-            console.error('Error:', response.data.error);
+            console.error('Error:', job.error);
             if (spinnerText) spinnerText.textContent = 'Error during measurement.';
         }
     } catch (error) {
@@ -63,6 +83,72 @@ async function measureBatch(batchId) {
     }
 }
 
+// Function to poll a background job until it has finished, showing its progress
+async function pollJob(statusUrl, progressText, interval = 1000) {
+    while (true) {
+        const response = await axios.get(statusUrl);
+        const job = response.data.job;
+        if (job.status === 'completed' || job.status === 'failed') {
+            return job;
+        }
+
+        // Show the number of processed entries and the estimated remaining time
+        if (progressText && job.total) {
+            let text = `Measuring entry ${job.processed} of ${job.total}`;
+            if (job.eta_seconds !== null) {
+                text += ` (about ${Math.ceil(job.eta_seconds)}s remaining)`;
+            }
+            progressText.textContent = text + '...';
+        }
+        await new Promise(resolve => setTimeout(resolve, interval));
+    }
+}
+
+// Page of entries last loaded into the predicted images grid (the first page is rendered by the server)
+let entriesPage = 1;
+
+// Function to load the next page of entries into the predicted images grid
+async function loadMoreEntries(batchId) {
+    const loadMoreButton = document.getElementById('load-more-button');
+    const predictedImages = document.getElementById('predicted-images');
+    loadMoreButton.disabled = true;
+
+    try {
+        const response = await axios.get(`/batch/${batchId}/entries`, { params: { page: entriesPage + 1 } });
+        const data = response.data;
+        entriesPage = data.page;
+
+        data.entries.forEach(entry => {
+            const wrapper = document.createElement('div');
+            wrapper.className = 'image-wrapper';
+            wrapper.onclick = () => showDetails(entry.original_image_url, entry.predicted_image_url, entry.temperature, entry.humidity, entry.predicted_seedlings, entry.average_height);
+
+            const image = document.createElement('img');
+            image.src = entry.predicted_image_url;
+            image.alt = 'Predicted Image';
+            image.className = 'predicted-image';
+            image.loading = 'lazy';
+
+            const caption = document.createElement('p');
+            caption.textContent = entry.predicted_image_filepath.split(/[\\/]/).pop();
+
+            wrapper.appendChild(image);
+            wrapper.appendChild(caption);
+            predictedImages.appendChild(wrapper);
+        });
+
+        // Hide the button once all the entries are loaded
+        if (data.has_more) {
+            loadMoreButton.disabled = false;
+        } else {
+            loadMoreButton.style.display = 'none';
+        }
+    } catch (error) {
+        console.error('Error loading entries:', error);
+        loadMoreButton.disabled = false;
+    }
+}
+
 // Function to show the details modal for each image
 function showDetails(originalImagePath, predictedImagePath, temperature, humidity, predictedSeedlings, averageHeight) {
     const modal = document.getElementById('details-modal');
@@ -96,14 +182,14 @@ function closeModal() {
 
 // Function to download the CSV files for a batch
 function downloadCSV(batchId) {
-    // Send a request to the server to retrieve the CSV file paths
+    // Send a request to the server to retrieve the CSV download URLs
     axios.get(`/download_csv?batch_id=${batchId}`)
         .then(response => {
             const data = response.data;
             if (data.success) {
-                downloadFile(`/static/${data.csv_batch_file_path}`);
-                downloadFile(`/static/${data.csv_entries_file_path}`);
-                downloadFile(`/static/${data.csv_individual_heights_file_path}`);
+                downloadFile(data.csv_batch_file_path);
+                downloadFile(data.csv_entries_file_path);
+                downloadFile(data.csv_individual_heights_file_path);
             } else {
                 alert('Failed to download CSV files');
             }
@@ -118,7 +204,8 @@ function downloadCSV(batchId) {
 function downloadFile(filePath) {
     const link = document.createElement('a');
     link.href = filePath;
-    link.download = filePath.split('/').pop();
+    // Use the file name given by the server
+    link.download = '';
     document.body.appendChild(link);
     link.click();
     document.body.removeChild(link);
@@ -1,12 +1,15 @@
 import cv2
 import numpy as np
-import pandas as pd
-import matplotlib
-matplotlib.use('Agg')  # Use a non-interactive backend to ensure plots are saved
-import matplotlib.pyplot as plt
 import os
+import hashlib
+import threading
 import datetime as dt
-from stemhealth import app
+from sqlalchemy import func, select
+from stemhealth import app, db
+from stemhealth.models import Entry
+
+# Format of the timestamps in the environmental data and the image filenames
+ENV_TIMESTAMP_FORMAT = "%d-%m-%Y_%H-%M-%S"
 
 # Methods for routes.py
 # Check if the file extension is allowed
@@ -14,311 +17,250 @@ def allowed_file(filename, allowed_extensions):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
-# Method to get the start and end dates of the entries
-def get_start_end_dates(entries):
-    start_date = entries[0].timestamp.strftime('%A, %d-%m-%Y')
-    end_date = entries[-1].timestamp.strftime('%A, %d-%m-%Y')
-    return start_date, end_date
-
-# Return a sharpened version of the image, using an unsharp mask
-def sharpen_image(filename, kernel_size=(5, 5), sigma=1.0, amount=2.5, threshold=0):
-    image = cv2.imread(filename)
-    blurred = cv2.GaussianBlur(image, kernel_size, sigma)
-    sharpened = float(amount + 1) * image - float(amount) * blurred
-    sharpened = np.maximum(sharpened, np.zeros(sharpened.shape))
-    sharpened = np.minimum(sharpened, 255 * np.ones(sharpened.shape))
-    sharpened = sharpened.round().astype(np.uint8)
+# Index the environmental data readings by image filename, parsing each timestamp once
+def index_environmental_data(env_data):
+    env_index = {}
+    for item in env_data:
+        env_index[item['filename']] = {
+            'timestamp': dt.datetime.strptime(item['timestamp'], ENV_TIMESTAMP_FORMAT),
+            'temperature': item['temperature'],
+            'humidity': item['humidity']
+        }
+    return env_index
+
+# Build the Entry rows of the saved images, sorted by timestamp (earliest to latest)
+# Returns the rows and the filenames of the images without environmental data
+def build_entry_rows(saved_images, env_index, batch_id):
+    entry_rows = []
+    missing_env_data = []
+    for filename, original_image_filepath in saved_images:
+        reading = env_index.get(filename)
+        if reading is None:
+            missing_env_data.append(filename)
+            continue
+        entry_rows.append({
+            'original_image_filepath': os.path.relpath(original_image_filepath, app.static_folder),  # Get relative path to static folder
+            'timestamp': reading['timestamp'],
+            'temperature': reading['temperature'],
+            'humidity': reading['humidity'],
+            'batch_id': batch_id
+        })
+    entry_rows.sort(key=lambda row: row['timestamp'])
+    return entry_rows, missing_env_data
+
+# Return a sharpened version of the image (a file path or an already decoded image), using an unsharp mask
+# The result is computed with saturating uint8 arithmetic; blurred and out can be passed as reusable scratch buffers
+def sharpen_image(image, kernel_size=(5, 5), sigma=1.0, amount=2.5, threshold=0, blurred=None, out=None):
+    if isinstance(image, str):
+        image = cv2.imread(image)
+    blurred = cv2.GaussianBlur(image, kernel_size, sigma, dst=blurred)
+    # (amount + 1) * image - amount * blurred, rounded and clipped to [0, 255]
+    sharpened = cv2.addWeighted(image, float(amount + 1), blurred, -float(amount), 0, dst=out)
     if threshold > 0:
-        low_contrast_mask = np.absolute(image - blurred) < threshold
+        low_contrast_mask = cv2.absdiff(image, blurred) < threshold
         np.copyto(sharpened, image, where=low_contrast_mask)
     return sharpened
 
-# Methods for plotting the graphs and saving them with a filename derived from the plot title
-def save_plot_with_title(title, save_folder):
-    # Construct the filename from the title
-    filename = title.replace(' ', '_') + '.png'
-    output_path = os.path.join(save_folder, filename)
-
-    # Save the figure with the constructed filename
-    plt.savefig(output_path)
-    plt.close()
-
-# Method to plot the average height of seedlings over time
-def plot_average_height(batch_data, entry_data, graphs_folder):
-    title = 'Average Height of Seedlings Over Time'
-    
-    # Extract the optimum entry ID from batch_data
-    optimum_entry_id = batch_data['optimum_entry_id'].values[0]
-    
-    # Find the optimum height from entry_data based on the optimum_entry_id
-    optimum_row = entry_data[entry_data['id'] == optimum_entry_id]
-    if not optimum_row.empty:
-        optimum_height = optimum_row['average_height'].values[0]
-        optimum_timestamp = optimum_row['timestamp'].values[0]
-        optimum_label = f'Optimum Height at {optimum_timestamp}'
-
-    # Create a time series plot
-    plt.figure(figsize=(14, 8))
-    
-    # Plot the average height over time
-    plt.plot(entry_data['timestamp'], entry_data['average_height'], marker='o', label='Average Height')
-    
-    # Add a dashed horizontal line for the optimum height if the optimum height is available
-    if optimum_height is not None:
-        plt.axhline(y=optimum_height, color='green', linestyle='--', label=optimum_label)
-        plt.text(entry_data['timestamp'].iloc[-1], optimum_height, f'Optimum Height: {optimum_height:.2f} cm', 
-                 color='green', fontsize=12, ha='right', va='bottom')
-
-    plt.xlabel('Timestamp')
-    plt.ylabel('Average Height (cm)')
-    plt.title(title)
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    
-    # Add a legend to the plot
-    plt.legend()
-    save_plot_with_title(title, graphs_folder)
-
-
-# Method to plot the temperature and humidity over time
-def plot_temperature_humidity(entry_data, graphs_folder):
-    title = 'Temperature and Humidity Over Time'
-    # Create a figure and a primary axis
-    fig, ax1 = plt.subplots(figsize=(14, 8))
-
-    # Plot Temperature over Time on the primary y-axis
-    line1, = ax1.plot(entry_data['timestamp'], entry_data['temperature'], color='red', label='Temperature (°C)')
-    ax1.set_xlabel('Timestamp')
-    ax1.set_ylabel('Temperature (°C)', color='red')
-    ax1.tick_params(axis='y', labelcolor='red')
-    ax1.set_title(title)
-
-    # Create a secondary y-axis for Humidity
-    ax2 = ax1.twinx()
-    line2, = ax2.plot(entry_data['timestamp'], entry_data['humidity'], color='blue', label='Humidity (%)')
-    ax2.set_ylabel('Humidity (%)', color='blue')
-    ax2.tick_params(axis='y', labelcolor='blue')
-
-    # Rotate x-axis labels
-    fig.autofmt_xdate()
-
-    # Add grid and legends
-    ax1.grid(True)
-
-    # Combine legends from both axes
-    lines = [line1, line2]
-    labels = [line.get_label() for line in lines]
-    ax1.legend(lines, labels, loc='upper left')
-
-    fig.tight_layout()  # Adjust layout to ensure everything fits without overlap
-    save_plot_with_title(title, graphs_folder)
-    
-# Method to plot the temperature and height over time
-def plot_temperature_height(batch_data, entry_data, graphs_folder):
-    title = 'Temperature and Average Height Over Time'
-    # Create a figure and a primary axis
-    fig, ax1 = plt.subplots(figsize=(14, 8))
-    
-    # Extract the optimum entry ID from batch_data
-    optimum_entry_id = batch_data['optimum_entry_id'].values[0]
-    
-    # Find the optimum height from entry_data based on the optimum_entry_id
-    optimum_row = entry_data[entry_data['id'] == optimum_entry_id]
-    if not optimum_row.empty:
-        optimum_height = optimum_row['average_height'].values[0]
-        optimum_timestamp = optimum_row['timestamp'].values[0]
-        optimum_label = f'Optimum Height: {optimum_height:.2f} cm at {optimum_timestamp}'
-    else:
-        optimum_height = None
-        optimum_label = 'Optimum Height (Data Not Found)'
-
-    # Plot Temperature over Time on the primary y-axis
-    line1, = ax1.plot(entry_data['timestamp'], entry_data['temperature'], color='red', label='Temperature (°C)')
-    ax1.set_xlabel('Timestamp')
-    ax1.set_ylabel('Temperature (°C)', color='red')
-    ax1.tick_params(axis='y', labelcolor='red')
-    ax1.set_title(title)
-
-    # Create a secondary y-axis for Height
-    ax2 = ax1.twinx()
-    line2, = ax2.plot(entry_data['timestamp'], entry_data['average_height'], color='green', label='Average Height (cm)')
-    ax2.set_ylabel('Average Height (cm)', color='green')
-    ax2.tick_params(axis='y', labelcolor='green')
-
-    # Rotate x-axis labels
-    fig.autofmt_xdate()
-
-    # Add grid and legends
-    ax1.grid(True)
-
-    # Combine legends from both axes
-    lines = [line1, line2]
-    labels = [line.get_label() for line in lines]
-    ax1.legend(lines, labels, loc='upper left')
-
-    # Add a horizontal dashed line for the optimum height if the optimum height is available
-    if optimum_height is not None:
-        ax2.axhline(y=optimum_height, color='blue', linestyle='--', label=optimum_label)
-        ax2.text(entry_data['timestamp'].iloc[-1], optimum_height, f'Optimum Height: {optimum_height:.2f} cm', 
-                 color='blue', fontsize=12, ha='right', va='bottom')
-
-    fig.tight_layout()  # Adjust layout to ensure everything fits without overlap
-    
-    # Save the plot with the title
-    save_plot_with_title(title, graphs_folder)
-
-    
-# # Method to plot the humidity and height over time
-def plot_humidity_height(batch_data, entry_data, graphs_folder):
-    title = 'Humidity and Average Height Over Time'
-    # Create a figure and a primary axis
-    fig, ax1 = plt.subplots(figsize=(14, 8))
-    
-    # Extract the optimum entry ID from batch_data
-    optimum_entry_id = batch_data['optimum_entry_id'].values[0]
-    
-    # Find the optimum height from entry_data based on the optimum_entry_id
-    optimum_row = entry_data[entry_data['id'] == optimum_entry_id]
-    if not optimum_row.empty:
-        optimum_height = optimum_row['average_height'].values[0]
-        optimum_timestamp = optimum_row['timestamp'].values[0]
-        optimum_label = f'Optimum Height: {optimum_height:.2f} cm at {optimum_timestamp}'
-    else:
-        optimum_height = None
-        optimum_label = 'Optimum Height (Data Not Found)'
-
-    # Plot Humidity over Time on the primary y-axis
-    line1, = ax1.plot(entry_data['timestamp'], entry_data['humidity'], color='blue', label='Humidity (%)')
-    ax1.set_xlabel('Timestamp')
-    ax1.set_ylabel('Humidity (%)', color='blue')
-    ax1.tick_params(axis='y', labelcolor='blue')
-    ax1.set_title(title)
-
-    # Create a secondary y-axis for Height
-    ax2 = ax1.twinx()
-    line2, = ax2.plot(entry_data['timestamp'], entry_data['average_height'], color='green', label='Average Height (cm)')
-    ax2.set_ylabel('Average Height (cm)', color='green')
-    ax2.tick_params(axis='y', labelcolor='green')
-
-    # Rotate x-axis labels
-    fig.autofmt_xdate()
-
-    # Add grid and legends
-    ax1.grid(True)
-
-    # Combine legends from both axes
-    lines = [line1, line2]
-    labels = [line.get_label() for line in lines]
-    ax1.legend(lines, labels, loc='upper left')
-
-    # Add a horizontal dashed line for the optimum height if the optimum height is available
-    if optimum_height is not None:
-        ax2.axhline(y=optimum_height, color='purple', linestyle='--', label=optimum_label)
-        ax2.text(entry_data['timestamp'].iloc[-1], optimum_height, f'Optimum Height: {optimum_height:.2f} cm', 
-                 color='purple', fontsize=12, ha='right', va='bottom')
-
-    fig.tight_layout()  # Adjust layout to ensure everything fits without overlap
-    
-    # Save the plot with the title
-    save_plot_with_title(title, graphs_folder)
-
-# Method to ensure the graphs are generated only if they do not already exist
-def ensure_graphs_generated(batch_data, entry_data, graphs_folder):
-    # Create the graphs folder 
-    os.makedirs(graphs_folder, exist_ok=True)
-    
-    # Check if the graphs folder is empty
-    if not os.listdir(graphs_folder):  
-        plot_average_height(batch_data, entry_data, graphs_folder)
-        plot_temperature_humidity(entry_data, graphs_folder)
-        plot_temperature_height(batch_data, entry_data, graphs_folder)
-        plot_humidity_height(batch_data, entry_data, graphs_folder)
-    else:
-        print("Graphs already exist. Skipping generation.")
-
-# Method to save the batch data and its related entries and individual heights to separate CSV files
-def save_batch_data_to_csv(batch):
-    # Collect Batch data
-    batch_data = [{
-        'id': batch.id,
-        'name': batch.name,
-        'species': batch.species,
-        'optimum_duration': batch.optimum_duration,
-        'optimum_entry_id': batch.optimum_entry_id
-    }]
-    
-    # Collect Entries data
-    entries_data = []
-    individual_heights_data = []
-    
-    # Collect data for each Entry and IndividualHeight
-    for entry in batch.entries:
-        entries_data.append({
-            'id': entry.id,
-            'original_image_filepath': entry.original_image_filepath,
-            'timestamp': dt.datetime.strftime(entry.timestamp, "%d-%m-%Y_%H-%M-%S"),
-            'temperature': entry.temperature,
-            'humidity': entry.humidity,
-            'predicted_image_filepath': entry.predicted_image_filepath,
-            'predicted_seedlings': entry.predicted_seedlings,
-            'average_height': entry.average_height,
-            'batch_id': entry.batch_id
-        })
-        
-        for individual_height in entry.individual_heights:
-            ih_dict = individual_height.to_dict()
-            ih_dict['entry_id'] = entry.id
-            individual_heights_data.append(ih_dict)
-
-    # Create DataFrames
-    df_batch = pd.DataFrame(batch_data)
-    df_entries = pd.DataFrame(entries_data)
-    df_individual_heights = pd.DataFrame(individual_heights_data)
-
-    # Define file names for each CSV file
-    base_filename = f"{batch.name.replace(' ', '_')}"
-    csv_batch_filename = f"{base_filename}_batch.csv"
-    csv_entries_filename = f"{base_filename}_entry.csv"
-    csv_individual_heights_filename = f"{base_filename}_individual_height.csv"
-
-    base_path = os.path.join(app.static_folder, 'seedling_data', batch.name.replace(' ', '_'), 'csv_data')
-    
-    # Ensure the directory exists
-    os.makedirs(base_path, exist_ok=True)
-    
-    # Define file paths for each CSV file
-    csv_batch_file_path = os.path.join(base_path, csv_batch_filename)
-    csv_entries_file_path = os.path.join(base_path, csv_entries_filename)
-    csv_individual_heights_file_path = os.path.join(base_path, csv_individual_heights_filename)
-
-    # Save DataFrames to CSV files
-    df_batch.to_csv(csv_batch_file_path)
-    df_entries.to_csv(csv_entries_file_path)
-    df_individual_heights.to_csv(csv_individual_heights_file_path)
-
-    return csv_batch_file_path, csv_entries_file_path, csv_individual_heights_file_path
+# Declarative specs of the batch graphs
+# Each series is plotted on its own y-axis (the second one on a twin axis); the optimum height line goes on the height axis
+CHART_SPECS = [
+    {'title': 'Average Height of Seedlings Over Time',
+     'series': [{'column': 'average_height', 'label': 'Average Height', 'ylabel': 'Average Height (cm)', 'color': None, 'marker': 'o'}],
+     'optimum_color': 'green'},
+    {'title': 'Temperature and Humidity Over Time',
+     'series': [{'column': 'temperature', 'label': 'Temperature (°C)', 'ylabel': 'Temperature (°C)', 'color': 'red'},
+                {'column': 'humidity', 'label': 'Humidity (%)', 'ylabel': 'Humidity (%)', 'color': 'blue'}],
+     'optimum_color': None},
+    {'title': 'Temperature and Average Height Over Time',
+     'series': [{'column': 'temperature', 'label': 'Temperature (°C)', 'ylabel': 'Temperature (°C)', 'color': 'red'},
+                {'column': 'average_height', 'label': 'Average Height (cm)', 'ylabel': 'Average Height (cm)', 'color': 'green'}],
+     'optimum_color': 'blue'},
+    {'title': 'Humidity and Average Height Over Time',
+     'series': [{'column': 'humidity', 'label': 'Humidity (%)', 'ylabel': 'Humidity (%)', 'color': 'blue'},
+                {'column': 'average_height', 'label': 'Average Height (cm)', 'ylabel': 'Average Height (cm)', 'color': 'green'}],
+     'optimum_color': 'purple'},
+]
+
+# Get the filename of a graph, derived from its title
+def chart_filename(title):
+    return title.replace(' ', '_') + '.png'
+
+# Get the entry data columns a graph is plotted from
+def chart_columns(spec):
+    columns = ['timestamp'] + [series['column'] for series in spec['series']]
+    if spec['optimum_color']:
+        columns.append('id')
+    return columns
+
+# The graph data of a batch, parsed once and shared by all its graphs
+class ChartData:
+    def __init__(self, batch_data, entry_data):
+        import pandas as pd
+        # Plot against parsed timestamps, so the x-axis gets a bounded number of date ticks rather than one label per entry
+        self.timestamps = pd.to_datetime(entry_data['timestamp'], format=ENV_TIMESTAMP_FORMAT).to_numpy()
+        self.columns = {column: entry_data[column].to_numpy() for column in entry_data.columns}
+
+        # Find the optimum height from entry_data based on the optimum entry ID of the batch
+        self.optimum_height = None
+        self.optimum_timestamp = None
+        optimum_entry_id = batch_data['optimum_entry_id'].values[0]
+        optimum_row = entry_data[entry_data['id'] == optimum_entry_id]
+        if not optimum_row.empty:
+            self.optimum_height = optimum_row['average_height'].values[0]
+            self.optimum_timestamp = optimum_row['timestamp'].values[0]
+
+# Renders each graph spec on its own figure and Agg canvas, kept for the next renders: the axes, lines and optimum
+# line of a graph are created by its first render and only get new data afterwards
+class ChartRenderer:
+    def __init__(self, figsize=(14, 8)):
+        self.figsize = figsize
+        # Figure and artists of each graph, by title
+        self.charts = {}
+
+    # Create the figure of a graph with its axes, labels and (empty) lines
+    def _build(self, spec):
+        # matplotlib is imported by the first graph render rather than with the application
+        import matplotlib.dates as mdates
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        figure = Figure(figsize=self.figsize)
+        FigureCanvasAgg(figure)
+        ax1 = figure.add_subplot()
+        axes = [ax1]
+        lines = []
+        dual_axis = len(spec['series']) > 1
+
+        for i, series in enumerate(spec['series']):
+            if i > 0:
+                axes.append(ax1.twinx())
+            ax = axes[i]
+            # Empty timestamps give the x-axis its date units
+            line, = ax.plot(np.array([], dtype='datetime64[ns]'), np.array([], dtype=np.float64), color=series['color'],
+                            marker=series.get('marker'), label=series['label'])
+            lines.append(line)
+            if dual_axis:
+                ax.set_ylabel(series['ylabel'], color=series['color'])
+                ax.tick_params(axis='y', labelcolor=series['color'])
+            else:
+                ax.set_ylabel(series['ylabel'])
+
+        ax1.set_xlabel('Timestamp')
+        ax1.xaxis.set_major_locator(mdates.AutoDateLocator(maxticks=20))
+        ax1.xaxis.set_major_formatter(mdates.DateFormatter('%d-%m-%Y %H:%M'))
+        ax1.set_title(spec['title'])
+        ax1.grid(True)
+
+        # Dashed horizontal line and label for the optimum height, shown when the batch has one
+        optimum_line = None
+        optimum_text = None
+        if spec['optimum_color']:
+            height_axis = axes[[series['column'] for series in spec['series']].index('average_height')]
+            optimum_line = height_axis.axhline(y=0, color=spec['optimum_color'], linestyle='--', visible=False)
+            optimum_text = height_axis.text(0, 0, '', color=spec['optimum_color'], fontsize=12, ha='right', va='bottom',
+                                            visible=False)
+        # Layout of a new figure, which every render starts its tight layout from
+        subplot_params = {name: getattr(figure.subplotpars, name) for name in ('left', 'bottom', 'right', 'top', 'wspace', 'hspace')}
+        return {'figure': figure, 'axes': axes, 'lines': lines, 'optimum_line': optimum_line, 'optimum_text': optimum_text,
+                'subplot_params': subplot_params}
+
+    # Draw a graph from its spec and save it once per (path, dpi) output, e.g. a full size image and a thumbnail
+    def render(self, spec, data, outputs):
+        if spec['title'] not in self.charts:
+            self.charts[spec['title']] = self._build(spec)
+        chart = self.charts[spec['title']]
+        figure = chart['figure']
+        axes = chart['axes']
+        lines = list(chart['lines'])
+        dual_axis = len(spec['series']) > 1
+
+        for line, series in zip(chart['lines'], spec['series']):
+            line.set_data(data.timestamps, data.columns[series['column']])
+
+        # Show the optimum height if the optimum height is available
+        optimum_line = chart['optimum_line']
+        if optimum_line is not None:
+            has_optimum = data.optimum_height is not None
+            optimum_line.set_visible(has_optimum)
+            chart['optimum_text'].set_visible(has_optimum)
+            if has_optimum:
+                optimum_line.set_ydata([data.optimum_height, data.optimum_height])
+                optimum_line.set_label(f'Optimum Height: {data.optimum_height:.2f} cm at {data.optimum_timestamp}')
+                chart['optimum_text'].set_position((data.timestamps[-1], data.optimum_height))
+                chart['optimum_text'].set_text(f'Optimum Height: {data.optimum_height:.2f} cm')
+                if not dual_axis:
+                    lines.append(optimum_line)
+
+        # Fit the axes to the new data (the hidden optimum line does not count)
+        for ax in axes:
+            ax.relim(visible_only=True)
+            ax.autoscale_view()
+
+        # Rotate x-axis labels
+        ax1 = axes[0]
+        figure.subplots_adjust(**chart['subplot_params'])
+        if dual_axis:
+            figure.autofmt_xdate()
+        else:
+            for label in ax1.get_xticklabels():
+                label.set_rotation(45)
+
+        # Combine legends from all axes (their entries depend on whether the batch has an optimum)
+        ax1.legend(lines, [line.get_label() for line in lines], loc='upper left' if dual_axis else 'best')
+        figure.tight_layout()  # Adjust layout to ensure everything fits without overlap
+
+        for path, dpi in outputs:
+            figure.savefig(path, dpi=dpi)
+
+# Renderer of the current thread, so its figures and artists are reused across batches
+_renderers = threading.local()
+
+def get_chart_renderer():
+    if not hasattr(_renderers, 'renderer'):
+        _renderers.renderer = ChartRenderer()
+    return _renderers.renderer
+
+# Render the requested graphs of a batch into graphs_folder (and optionally their thumbnails into thumbnails_folder)
+def render_charts(batch_data, entry_data, graphs_folder, titles=None, dpi=100, thumbnails_folder=None, thumbnail_dpi=40):
+    data = ChartData(batch_data, entry_data)
+    renderer = get_chart_renderer()
+    for spec in CHART_SPECS:
+        if titles is not None and spec['title'] not in titles:
+            continue
+        filename = chart_filename(spec['title'])
+        outputs = [(os.path.join(graphs_folder, filename), dpi)]
+        if thumbnails_folder:
+            outputs.append((os.path.join(thumbnails_folder, filename), thumbnail_dpi))
+        renderer.render(spec, data, outputs)
+
+# Method to compute the content hash of a file (model weights, images)
+def file_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
 
 # Method to calculate the optimum duration for a batch of seedlings
+# The entries are searched by the database, so batches that grow by appended frames are not loaded in full
 def calculate_optimum_duration(batch):
-    entries = batch.entries
     target_height = 2.0  # cm
-    closest_entry = None
-    min_diff = float('inf')
-    
-    # Assuming entries are sorted by timestamp
-    first_entry = entries[0]
-    
-    # Find the entry with the closest average height to the target height
-    for entry in entries:
-        diff = abs(entry.average_height - target_height)
-        if diff < min_diff:
-            min_diff = diff
-            closest_entry = entry
-    
+
+    # Get the timestamp of the first entry
+    first_timestamp = db.session.execute(
+        select(func.min(Entry.timestamp)).where(Entry.batch_id == batch.id)
+    ).scalar()
+
+    # Find the entry with the closest average height to the target height (the earliest added on ties)
+    closest_entry = db.session.execute(
+        select(Entry.id, Entry.timestamp)
+        .where(Entry.batch_id == batch.id, Entry.average_height.isnot(None))
+        .order_by(func.abs(Entry.average_height - target_height), Entry.id)
+        .limit(1)
+    ).first()
+
     # Calculate the duration between the first entry and the closest entry
     if closest_entry:
-        duration = closest_entry.timestamp - first_entry.timestamp
+        duration = closest_entry.timestamp - first_timestamp
         days, seconds = duration.days, duration.seconds
         hours = seconds // 3600
         # minutes = (seconds % 3600) // 60
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Import the stemhealth package from the Web_Application folder, with an in-memory database so the tests never
+# change site.db
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('STEMHEALTH_DATABASE_URI', 'sqlite:///:memory:')
@@ -0,0 +1,132 @@
+import glob
+import os
+import cv2
+import numpy as np
+import pytest
+from stemhealth import app, measurement
+
+STATIC_FOLDER = app.static_folder
+SAMPLE_BATCHES = ('Batch_1', 'Batch_2')
+
+
+# Reference implementations: the per-pixel loops measurement.py used before the NumPy scans
+def baseline_extend_line_to_right_boundary(mask, coord):
+    y = coord[1]
+    x = coord[0]
+    right_end = None
+    inside_boundary = False
+    for i in range(x, mask.shape[1]):
+        current_value = mask[y, i]
+        if current_value > 0:
+            if not inside_boundary:
+                inside_boundary = True
+        elif inside_boundary:
+            right_end = (i, y)
+            break
+    return right_end
+
+def baseline_extend_line_to_boundary(mask, coord):
+    y = coord[1]
+    x = coord[0]
+    left_end = None
+    for i in range(x, -1, -1):
+        if mask[y, i] > 0:
+            left_end = (i, y)
+            break
+    return left_end
+
+def baseline_find_top_edge(mask, x):
+    for y in range(mask.shape[0]):
+        if mask[y, x] > 0:
+            return (x, y)
+    return None
+
+def baseline_process_image(reference_mask, x1, y1, x2, y2):
+    height = y2 - y1
+    left_end = baseline_extend_line_to_boundary(reference_mask, (x2, y2))
+    top_edge_point = baseline_find_top_edge(reference_mask, left_end[0])
+    scale = 5 / (left_end[1] - top_edge_point[1])
+    return float("{:.2f}".format(height * scale))
+
+
+# Random masks of filled polygons and blobs, with empty rows and columns
+def synthetic_masks():
+    rng = np.random.default_rng(0)
+    masks = []
+    for _ in range(6):
+        mask = np.zeros((48, 64), dtype=np.uint8)
+        for _ in range(rng.integers(1, 4)):
+            points = rng.integers(0, [64, 48], size=(rng.integers(3, 7), 2)).astype(np.int32)
+            cv2.fillPoly(mask, [points], 255)
+        masks.append(mask)
+    blobs = (rng.random((48, 64)) > 0.7).astype(np.uint8) * 255
+    masks.append(blobs)
+    masks.append(np.zeros((48, 64), dtype=np.uint8))
+    return masks
+
+@pytest.fixture(scope='module')
+def reference_masks():
+    return measurement.get_reference_object_mask(os.path.join(STATIC_FOLDER, 'reference_object.png'))
+
+# The first image of each sample batch, which the sponge mask of its batch is computed from
+@pytest.fixture(scope='module', params=SAMPLE_BATCHES)
+def sponge_image_path(request):
+    images = sorted(glob.glob(os.path.join(STATIC_FOLDER, 'seedling_data', request.param, 'original_images', '*.png')))
+    if not images:
+        pytest.skip(f"No sample images in {request.param}")
+    return images[0]
+
+
+@pytest.mark.parametrize('mask', synthetic_masks())
+def test_scans_match_baseline_on_synthetic_masks(mask):
+    height, width = mask.shape
+    for y in range(height):
+        for x in range(width):
+            assert measurement.extend_line_to_right_boundary(mask, (x, y)) == baseline_extend_line_to_right_boundary(mask, (x, y))
+            assert measurement.extend_line_to_boundary(mask, (x, y)) == baseline_extend_line_to_boundary(mask, (x, y))
+    for x in range(width):
+        assert measurement.find_top_edge(mask, x) == baseline_find_top_edge(mask, x)
+
+def test_scans_match_baseline_on_sample_masks(reference_masks, sponge_image_path):
+    _, simplified_reference_mask, _ = reference_masks
+    _, simplified_sponge_mask, _ = measurement.get_sponge_mask(sponge_image_path)
+    for mask in (simplified_reference_mask, simplified_sponge_mask):
+        height, width = mask.shape
+        for y in range(0, height, 9):
+            for x in range(0, width, 37):
+                assert measurement.extend_line_to_right_boundary(mask, (x, y)) == baseline_extend_line_to_right_boundary(mask, (x, y))
+                assert measurement.extend_line_to_boundary(mask, (x, y)) == baseline_extend_line_to_boundary(mask, (x, y))
+        for x in range(width):
+            assert measurement.find_top_edge(mask, x) == baseline_find_top_edge(mask, x)
+
+def test_eligible_area_matches_baseline(reference_masks, sponge_image_path, monkeypatch):
+    _, simplified_reference_mask, simplified_reference_mask_approx = reference_masks
+    _, simplified_sponge_mask, simplified_sponge_mask_approx = measurement.get_sponge_mask(sponge_image_path)
+    args = (simplified_reference_mask, simplified_sponge_mask, simplified_reference_mask_approx, simplified_sponge_mask_approx)
+    eligible_area_mask = measurement.find_eligible_seedling_position(*args)
+    monkeypatch.setattr(measurement, 'extend_line_to_right_boundary', baseline_extend_line_to_right_boundary)
+    np.testing.assert_array_equal(eligible_area_mask, measurement.find_eligible_seedling_position(*args))
+
+def test_heights_match_baseline(reference_masks, sponge_image_path):
+    _, simplified_reference_mask, simplified_reference_mask_approx = reference_masks
+    _, simplified_sponge_mask, simplified_sponge_mask_approx = measurement.get_sponge_mask(sponge_image_path)
+    geometry = measurement.MeasurementGeometry.build(simplified_reference_mask, simplified_sponge_mask,
+                                                     simplified_reference_mask_approx, simplified_sponge_mask_approx)
+
+    # Random seedling boxes with their bottom-right corner in the eligible area, as the baseline measured them
+    rng = np.random.default_rng(1)
+    ys, xs = np.nonzero(geometry.eligible_area_mask)
+    picks = rng.choice(len(xs), size=min(300, len(xs)), replace=False)
+    boxes = []
+    for i in picks:
+        x2, y2 = int(xs[i]), int(ys[i])
+        height = int(rng.integers(2, min(y2, 200)))
+        width = int(rng.integers(1, height))
+        boxes.append((x2 - width, y2 - height, x2, y2))
+
+    expected = [baseline_process_image(simplified_reference_mask, *box) for box in boxes]
+    assert [geometry.measure(*box) for box in boxes] == expected
+    assert [measurement.process_image(simplified_reference_mask, *box) for box in boxes] == expected
+    eligible, heights = geometry.measure_boxes(np.array(boxes, dtype=np.float32))
+    assert eligible.all()
+    assert heights.tolist() == expected
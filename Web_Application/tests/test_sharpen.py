@@ -0,0 +1,35 @@
+import glob
+import os
+import cv2
+import numpy as np
+import pytest
+from stemhealth import app
+from stemhealth.util import sharpen_image
+
+SAMPLE_IMAGES = sorted(glob.glob(os.path.join(app.static_folder, 'seedling_data', '*', 'original_images', '*.png')))
+
+
+# Reference implementation: the float64 sharpening used before the saturating uint8 arithmetic
+def baseline_sharpen_image(image, kernel_size=(5, 5), sigma=1.0, amount=2.5):
+    blurred = cv2.GaussianBlur(image, kernel_size, sigma)
+    sharpened = float(amount + 1) * image - float(amount) * blurred
+    sharpened = np.maximum(sharpened, np.zeros(sharpened.shape))
+    sharpened = np.minimum(sharpened, 255 * np.ones(sharpened.shape))
+    return sharpened.round().astype(np.uint8)
+
+
+@pytest.mark.parametrize('image_path', SAMPLE_IMAGES[::4], ids=os.path.basename)
+def test_sharpen_matches_baseline_on_sample_images(image_path):
+    image = cv2.imread(image_path)
+    expected = baseline_sharpen_image(image)
+    np.testing.assert_array_equal(sharpen_image(image), expected)
+    # Loading from a path and reusing scratch buffers give the same bytes
+    blurred = np.empty_like(image)
+    out = np.empty_like(image)
+    np.testing.assert_array_equal(sharpen_image(image_path, blurred=blurred, out=out), expected)
+
+@pytest.mark.parametrize('amount', [0.5, 1.0, 2.5, 4.0])
+def test_sharpen_matches_baseline_on_random_frames(amount):
+    rng = np.random.default_rng(int(amount * 10))
+    image = rng.integers(0, 256, size=(120, 160, 3), dtype=np.uint8)
+    np.testing.assert_array_equal(sharpen_image(image, amount=amount), baseline_sharpen_image(image, amount=amount))